@@ -0,0 +1,245 @@
+# Render benchmark with generated calendars, a recorded forecast and a fixed wallpaper, no network needed.
+#
+#   python benchmark.py                  run every scenario and compare with the baseline
+#   python benchmark.py --save-baseline  run and store the results as the new baseline
+#   python benchmark.py --events 100 1000 --views month
+#
+# Each scenario runs in its own process and work directory, with the date, clock, timezone,
+# locale and wallpaper pinned, so two runs on the same machine render the same frames.
+from PIL import Image
+import argparse
+import datetime
+import functools
+import http.server
+import json
+import locale
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from zoneinfo import ZoneInfo
+
+BENCH_NOW = datetime.datetime(2025, 3, 12, 10, 0)  # a six-week month
+BENCH_TZ = "Europe/Stockholm"
+BENCH_LOCALES = ["sv_SE.UTF-8", "C.UTF-8"]  # first one available is used
+BENCH_EVENTS = [100, 1000, 10000]
+BENCH_VIEWS = ["month", "week"]
+BENCH_FEEDS = 3
+BENCH_WARM_RUNS = 3
+STAGES = ["feeds", "index", "forecast", "static", "dynamic", "quantize"]
+BASELINE_FILE = "benchmark_baseline.json"
+REGRESSION_TOLERANCE = 0.2  # flag anything this much slower or larger than the baseline
+REGRESSION_MIN_MS = 5  # ignore differences smaller than this, they are noise
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARED_DIRS = ["font", "weather-icons"]
+COLORS = ["#00FF00", "#FF0000", "#0000FF"]
+WORDS = ["lunch", "möte", "tandläkare", "träning", "kalas", "projektgenomgång", "middag", "resa", "städning", "kurs"]
+
+
+def generate_feeds(n_events, n_feeds, seed=0):
+    # About half single events, a quarter recurring series and a quarter multi-day spans,
+    # spread over a few months around BENCH_NOW
+    rng = random.Random(seed)
+    center = BENCH_NOW.replace(hour=0)
+    feeds = [[] for _ in range(n_feeds)]
+    for i in range(n_events):
+        start = center + datetime.timedelta(days=rng.randint(-60, 60), hours=rng.randint(6, 20), minutes=rng.choice([0, 15, 30, 45]))
+        summary = f"Event {i} " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+        kind = rng.random()
+        lines = ["BEGIN:VEVENT", f"UID:bench-{i}@kalendar", "DTSTAMP:20250101T000000Z", f"SUMMARY:{summary}"]
+        if kind < 0.5:
+            lines += [f"DTSTART:{start:%Y%m%dT%H%M%S}", f"DTEND:{start + datetime.timedelta(hours=1):%Y%m%dT%H%M%S}"]
+        elif kind < 0.75:
+            freq = rng.choice(["DAILY", "WEEKLY", "WEEKLY", "MONTHLY"])
+            lines += [f"DTSTART:{start:%Y%m%dT%H%M%S}", f"DTEND:{start + datetime.timedelta(minutes=45):%Y%m%dT%H%M%S}",
+                      f"RRULE:FREQ={freq};COUNT={rng.randint(5, 60)}"]
+        elif kind < 0.9:
+            days = rng.randint(2, 10)
+            lines += [f"DTSTART;VALUE=DATE:{start:%Y%m%d}", f"DTEND;VALUE=DATE:{start + datetime.timedelta(days=days):%Y%m%d}"]
+        else:
+            lines += [f"DTSTART:{start:%Y%m%dT%H%M%S}", f"DTEND:{start + datetime.timedelta(days=rng.randint(1, 4), hours=3):%Y%m%dT%H%M%S}"]
+        lines.append("END:VEVENT")
+        feeds[i % n_feeds].append("\r\n".join(lines))
+    return ["\r\n".join(["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//kalendar//benchmark//EN"] + events + ["END:VCALENDAR"]) + "\r\n" for events in feeds]
+
+def recorded_forecast():
+    # Meteosource point forecast, in the shape the API returns it, starting at BENCH_NOW
+    utc = lambda dt: dt.replace(tzinfo=ZoneInfo(BENCH_TZ)).astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    summaries = ["Sunny", "Partly sunny", "Mostly cloudy", "Light rain", "Overcast"]
+    return {"data": {
+        "lat": "59.86N", "lon": "17.64E", "elevation": 10, "timezone": "UTC", "units": "metric",
+        "current": {"icon_num": 4, "temperature": 4.3, "summary": "Partly sunny"},
+        "hourly": {"data": [{"icon": (i % 30) + 2, "date": utc(BENCH_NOW + datetime.timedelta(hours=i)), "temperature": i % 7 - 2, "summary": summaries[i % 5]} for i in range(48)]},
+        "daily": {"data": [{"icon": (i % 30) + 2, "day": (BENCH_NOW + datetime.timedelta(days=i - 1)).strftime("%Y-%m-%d"), "summary": summaries[i % 5]} for i in range(10)]},
+    }}
+
+def make_wallpaper(path):
+    # Camera-sized, so the wallpaper decode is part of the cold render
+    image = Image.linear_gradient("L").resize((4000, 3000))
+    Image.merge("RGB", (image, image.rotate(90).resize((4000, 3000)), image.transpose(Image.Transpose.FLIP_TOP_BOTTOM))).save(path, quality=90)
+
+def setup_workdir(workdir, n_events):
+    for name in SHARED_DIRS:
+        os.symlink(os.path.join(REPO_DIR, name), os.path.join(workdir, name))
+    os.makedirs(os.path.join(workdir, "feeds"))
+    for i, ics in enumerate(generate_feeds(n_events, BENCH_FEEDS)):
+        with open(os.path.join(workdir, "feeds", f"{i}.ics"), "w") as f:
+            f.write(ics)
+    for folder in ["wallpapers", "photos"]:
+        os.makedirs(os.path.join(workdir, folder))
+        make_wallpaper(os.path.join(workdir, folder, "bench.jpg"))
+    with open(os.path.join(workdir, "forecast.json"), "w") as f:
+        json.dump(recorded_forecast(), f)
+
+def serve_feeds(workdir):
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(Handler, directory=os.path.join(workdir, "feeds")))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def pin_locale():
+    for name in BENCH_LOCALES:
+        try:
+            locale.setlocale(locale.LC_ALL, name)
+            return name
+        except locale.Error:
+            continue
+    raise RuntimeError(f"None of {BENCH_LOCALES} is available")
+
+def run_scenario(n_events, view):
+    # Runs inside the scenario's own process, in its work directory
+    import draw_cal
+    import metrics
+    import weather
+
+    draw_cal.LOCALE = pin_locale()
+    draw_cal.PROFILES["default"] = draw_cal.PROFILES["default"]._replace(locale=draw_cal.LOCALE)
+    server = serve_feeds(os.getcwd())
+    with open("calendars.csv", "w") as f:
+        f.write("name,owner,color,url\n")
+        for i in range(BENCH_FEEDS):
+            f.write(f"bench{i},bench,{COLORS[i % len(COLORS)]},http://127.0.0.1:{server.server_address[1]}/{i}.ics\n")
+    with open("draw.json", "w") as f:
+        json.dump({"draw_option": view}, f)
+    weather.forecast_provider.fetch = lambda: weather.load_recorded_forecast("forecast.json")
+
+    # Stage times are read from the metrics records of draw_image, per-feed stages from the worker threads are left out
+    records = []
+    metrics.listeners.append(records.append)
+
+    def render(memory=False):
+        metrics.enable(log_file=None, memory=memory)
+        records.clear()
+        start = time.perf_counter()
+        out = draw_cal.draw_image(now=BENCH_NOW)
+        total = (time.perf_counter() - start) * 1000
+        metrics.emit_counters()
+        metrics.disable()
+        stages = {}
+        for record in records:
+            if record.get("stage") in STAGES:
+                stages[record["stage"]] = stages.get(record["stage"], 0) + record["ms"]
+        stages["total"] = total
+        peak = max((record.get("peak_kib", 0) for record in records), default=0)
+        return out, {k: round(v, 2) for k, v in stages.items()}, records[-1]["counters"], peak
+
+    out, cold, cold_counters, _ = render()
+    warm_runs = [render()[1] for _ in range(BENCH_WARM_RUNS)]
+    warm = {stage: round(sorted(run.get(stage, 0) for run in warm_runs)[len(warm_runs) // 2], 2) for stage in warm_runs[0]}
+    _, _, warm_counters, peak_kib = render(memory=True)
+
+    import resource
+    return {
+        "locale": draw_cal.LOCALE,
+        "frame": out.info["fingerprint"],
+        "cold_ms": cold,
+        "warm_ms": warm,
+        "warm_peak_kib": peak_kib,
+        "cold_counters": cold_counters,
+        "warm_counters": warm_counters,
+        "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    # Returns a list of regressions, as readable lines
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        for phase in ["cold_ms", "warm_ms"]:
+            for stage, ms in result[phase].items():
+                before = base[phase].get(stage)
+                if before is not None and ms > before * (1 + tolerance) and ms - before > REGRESSION_MIN_MS:
+                    regressions.append(f"{key} {phase} {stage}: {before:.1f} -> {ms:.1f} ms")
+        for field in ["warm_peak_kib", "max_rss_kib"]:
+            if result[field] > base[field] * (1 + tolerance):
+                regressions.append(f"{key} {field}: {base[field]} -> {result[field]} KiB")
+        if result["frame"] != base["frame"]:
+            print(f"note: {key} rendered a different frame than the baseline")
+    return regressions
+
+def print_results(results):
+    stages = STAGES + ["total"]
+    print(f"{'scenario':<14}{'phase':<6}" + "".join(f"{stage:>10}" for stage in stages) + f"{'peak KiB':>10}")
+    for key, result in results.items():
+        for phase in ["cold_ms", "warm_ms"]:
+            row = "".join(f"{result[phase].get(stage, 0):>10.1f}" for stage in stages)
+            peak = result["warm_peak_kib"] if phase == "warm_ms" else result["max_rss_kib"]
+            print(f"{key:<14}{phase[:4]:<6}{row}{peak:>10}")
+    print("peak KiB is the process max RSS for cold runs and the tracemalloc peak of a warm render")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark month and week renders on generated calendars")
+    parser.add_argument("--events", type=int, nargs="+", default=BENCH_EVENTS)
+    parser.add_argument("--views", nargs="+", default=BENCH_VIEWS, choices=BENCH_VIEWS)
+    parser.add_argument("--baseline", default=os.path.join(REPO_DIR, BASELINE_FILE))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument("--run", nargs=2, metavar=("EVENTS", "VIEW"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_scenario(int(args.run[0]), args.run[1])))
+        return 0
+
+    env = dict(os.environ, TZ=BENCH_TZ, PYTHONHASHSEED="0")
+    env.pop("KALENDAR_FORECAST_RECORDING", None)
+    env.pop("KALENDAR_METRICS", None)
+    results = {}
+    for n_events in args.events:
+        for view in args.views:
+            with tempfile.TemporaryDirectory() as workdir:
+                setup_workdir(workdir, n_events)
+                proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", str(n_events), view],
+                                      cwd=workdir, env=env, capture_output=True, text=True)
+            if proc.returncode != 0:
+                print(proc.stdout + proc.stderr)
+                return proc.returncode
+            results[f"{view}-{n_events}"] = json.loads(proc.stdout.strip().splitlines()[-1])
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline yet, run with --save-baseline to store one")
+        return 0
+    with open(args.baseline, "r") as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for line in regressions:
+        print("REGRESSION", line)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,8 +3,14 @@
 import gpiod
 import gpiodevice
 from gpiod.line import Bias, Direction, Edge, Value
-import subprocess
+import datetime
 import json
+import queue
+import threading
+from display import get_display
+import draw_cal
+from scheduler import RefreshScheduler
+from show_on_inky import poll, show_on_inky, show_view
 # GPIO pins for each button (from top to bottom)
 # These will vary depending on platform and the ones
 # below should be correct for Raspberry Pi 5.
@@ -54,6 +60,74 @@ led = chip.line_offset_from_id(LED_PIN)
 gpio = chip.request_lines(consumer="inky", config={led: gpiod.LineSettings(direction=Direction.OUTPUT, bias=Bias.DISABLED)})
 
 
+# Renders run on one long-lived thread so fonts, icons, parsed calendars and the
+# forecast stay loaded between presses instead of starting a new Python for each one.
+# Between presses the thread sleeps until the scheduler says the screen could change.
+class RenderService:
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.scheduler = RefreshScheduler()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def request_render(self, option=None):
+        # option: the view a button switched to, shown from the pre-rendered frames if possible
+        self.requests.put(option)
+
+    def run(self):
+        display = get_display()
+        draw_cal.prewarm_fonts()
+
+        while True:
+            try:
+                option = self.requests.get(timeout=self.scheduler.seconds_until_wake(datetime.datetime.now()))
+            except queue.Empty:
+                self.run_scheduled(display)
+                continue
+            # Presses that came in during the last render collapse into this one,
+            # draw.json already holds the latest choice
+            while True:
+                try:
+                    option = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+
+            gpio.set_value(led, Value.ACTIVE)
+            try:
+                if option:
+                    show_view(option, display=display)
+                else:
+                    show_on_inky(display=display)
+                    self.scheduler.drawn(datetime.datetime.now())
+            except Exception as e:
+                print(f"Render failed: {e!r}")
+            gpio.set_value(led, Value.INACTIVE)
+
+    def run_scheduled(self, display):
+        # No LED here, scheduled work mostly ends without touching the screen
+        now = datetime.datetime.now()
+        due = self.scheduler.due(now)
+        try:
+            if due == "redraw":
+                show_on_inky(display=display)
+                self.scheduler.drawn(now)
+            elif due == "poll":
+                poll(display=display)
+                self.scheduler.polled(now)
+        except Exception as e:
+            print(f"Scheduled {due} failed: {e!r}")
+            # Wait for the next poll instead of retrying right away, it redraws if the screen is behind
+            if due == "redraw":
+                self.scheduler.drawn(now)
+            else:
+                self.scheduler.polled(now)
+
+
+render_service = RenderService()
+
+
 # "handle_button" will be called every time a button is pressed
 # It receives one argument: the associated gpiod event object.
 def handle_button(event):
@@ -62,21 +136,22 @@ def handle_button(event):
     label = LABELS[index]
 
     print(f"Button press detected on GPIO #{gpio_number} label: {label}")
-    gpio.set_value(led, Value.ACTIVE)
+    option = None
     if label == "A":
-        with open("draw.json", "w") as f:
-            json.dump({"draw_option": "month"}, f)
+        option = "month"
     elif label == "B":
+        option = "week"
+    if option:
         with open("draw.json", "w") as f:
-            json.dump({"draw_option": "week"}, f)
+            json.dump({"draw_option": option}, f)
 
     print(label)
-    subprocess.run(["bash", "start.sh"])
-    gpio.set_value(led, Value.INACTIVE)
+    render_service.request_render(option)
 
 
 if __name__ == "__main__":
-    subprocess.run(["bash", "start.sh"])
+    render_service.start()
+    render_service.request_render()
 
     while True:
         events = request.read_edge_events()
@@ -0,0 +1,138 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import datetime
+import sys
+import threading
+import time
+from event_store import EventStore
+from feed_cache import FeedCache
+import metrics
+
+CALENDARS_FILE = "calendars.csv"
+FEED_DEADLINE = 45  # seconds each calendar gets before its stored events are shown instead
+EVENT_PREFETCH_DAYS = 14  # days expanded beyond each side of the window and reused by later refreshes
+
+
+class CalEvent:
+    # Only what the views draw, instead of the full icalevents.Event with its description,
+    # attendees, rrule and so on. Summaries and colours repeat a lot and are interned.
+    __slots__ = ("start", "end", "all_day", "summary", "color", "multiday")
+
+    def __init__(self, start: datetime.datetime, end: datetime.datetime, all_day: bool, summary: str, color: str):
+        self.start = start
+        self.end = end
+        self.all_day = all_day
+        self.summary = sys.intern(summary)
+        self.color = sys.intern(color)
+        self.multiday = start.date() != end.date() and not all_day
+
+def read_calendars(path=CALENDARS_FILE):
+    with open(path, "r") as csvfile:
+        reader = csv.reader(csvfile)
+        reader.__next__()
+        return [row for row in reader]
+
+def stored_events(store: EventStore, row, start, end):
+    return [CalEvent(event_start, event_end, all_day, summary, row[2]) for event_start, event_end, all_day, summary in store.query(row[3], start, end)]
+
+def parse_calendar(feed, row, start, end, prefetch_days=EVENT_PREFETCH_DAYS):
+    store = EventStore()
+    store.sync(row[3], feed, start, end, prefetch_days=prefetch_days, fix_apple=row[3].startswith("webcal://"))
+    return stored_events(store, row, start, end)
+
+def load_calendar(feed_cache: FeedCache, row, start, end):
+    with metrics.stage("feed.download", calendar=row[0]):
+        feed = feed_cache.fetch(row[3])
+    return parse_calendar(feed, row, start, end)
+
+def load_stored_calendar(feed_cache: FeedCache, row, start, end):
+    # The events of the last sync, if it covered the window and the feed behind it is still fresh.
+    # Nothing is parsed, a sync that is still running keeps the store to itself.
+    _, meta = feed_cache.load(row[3])
+    store = EventStore()
+    if not feed_cache.is_fresh(meta) or not store.covers(row[3], start, end):
+        return None
+    return stored_events(store, row, start, end)
+
+# Syncs by URL that are still running, possibly from an earlier refresh that gave up on them
+_syncing = {}
+_syncing_lock = threading.Lock()
+
+def _start_sync(executor, feed_cache: FeedCache, row, start, end):
+    # None if the URL is still being synced, a second sync would only race the first on the store
+    url = row[3]
+    with _syncing_lock:
+        if url in _syncing:
+            return None
+        future = executor.submit(load_calendar, feed_cache, row, start, end)
+        _syncing[url] = future
+
+    def done(_):
+        with _syncing_lock:
+            _syncing.pop(url, None)
+    future.add_done_callback(done)
+    return future
+
+def load_events(start, end, feed_cache: FeedCache = None):
+    feed_cache = feed_cache or FeedCache()
+    rows = read_calendars()
+
+    # Every calendar starts right away and gets its own FEED_DEADLINE
+    executor = ThreadPoolExecutor(max_workers=max(1, len(rows)))
+    futures = [_start_sync(executor, feed_cache, row, start, end) for row in rows]
+    deadline = time.monotonic() + FEED_DEADLINE
+
+    # Merge in calendars.csv order so the result doesn't depend on which feed answered first
+    events: list[CalEvent] = []
+    errors = []
+    for row, future in zip(rows, futures):
+        try:
+            if future is None:
+                raise TimeoutError("an earlier sync is still running")
+            es = future.result(timeout=max(0, deadline - time.monotonic()))
+        except Exception as e:
+            print(f"Could not load calendar {row[0]}: {e!r}")
+            errors.append(e)
+            es = load_stored_calendar(feed_cache, row, start, end)
+            if es is None:
+                continue
+        events.extend(es)
+
+    # Don't wait for feeds that blew the deadline, they finish in the background and the next
+    # refresh reads what they stored
+    executor.shutdown(wait=False)
+
+    if rows and len(errors) == len(rows) and not events:
+        raise errors[0]
+
+    return events
+
+
+class EventIndex:
+    def __init__(self, events: list[CalEvent], start: datetime.date = None, end: datetime.date = None):
+        multiday = defaultdict(list)
+        oneday = defaultdict(list)
+        self.multiday_event_days: dict[datetime.date, dict[CalEvent, str]] = defaultdict(dict)
+
+        for event in events:
+            event_start, event_end = event.start.date(), event.end.date()
+            if event.multiday:
+                event_len = (event_end - event_start).days + 1
+                # Only index the part of long spans that can end up on screen
+                first = max(0, (start - event_start).days) if start else 0
+                last = min(event_len, (end - event_start).days + 1) if end else event_len
+                for i in range(first, last):
+                    date = event_start + datetime.timedelta(days=i)
+                    multiday[date].append(event)
+                    self.multiday_event_days[date][event] = f"({i + 1}/{event_len})"
+            else:
+                oneday[event_start].append(event)
+
+        # Multiday events first in feed order, then the day's own events by start time
+        self.days: dict[datetime.date, list[CalEvent]] = {}
+        for date in multiday.keys() | oneday.keys():
+            self.days[date] = multiday[date] + sorted(oneday[date], key=lambda event: event.start)
+
+    def get_todays_events(self, date: datetime.date):
+        return self.days.get(date, []), self.multiday_event_days.get(date, {})
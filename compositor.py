@@ -0,0 +1,109 @@
+from PIL import Image
+import numpy as np
+
+TEXT_BACKGROUND_LUMA = 17  # #111111, the background colour of the text images
+LUT_BITS = 6  # bits per channel in the undithered RGB -> palette index table
+
+
+def text_mask(text_image: Image.Image):
+    # True where something was drawn on a "P" text image. Decided per palette entry with the same
+    # L conversion the old convert("L").point(...) mask used, then looked up for every pixel.
+    strip = Image.new("P", (256, 1))
+    strip.putdata(range(256))
+    strip.putpalette(text_image.getpalette())
+    drawn = np.asarray(strip.convert("L"))[0] != TEXT_BACKGROUND_LUMA
+    return drawn[np.asarray(text_image)]
+
+def composite_text(base: Image.Image, text_image: Image.Image):
+    # Text pixels replace the base, the text colours come straight from the text image's palette.
+    # RGBA bases get full alpha where there is text.
+    out = np.array(base)
+    mask = text_mask(text_image)
+    colors = np.asarray(text_image.getpalette(), dtype=np.uint8).reshape(-1, 3)
+    out[mask, :3] = colors[np.asarray(text_image)[mask]]
+    if out.shape[2] == 4:
+        out[mask, 3] = 255
+    return Image.fromarray(out, base.mode)
+
+def text_layer(text_image: Image.Image):
+    # The text image as RGBA with real alpha, so it can be pasted without knowing its palette
+    layer = np.zeros((text_image.height, text_image.width, 4), dtype=np.uint8)
+    mask = text_mask(text_image)
+    colors = np.asarray(text_image.getpalette(), dtype=np.uint8).reshape(-1, 3)
+    layer[mask, :3] = colors[np.asarray(text_image)[mask]]
+    layer[mask, 3] = 255
+    return Image.fromarray(layer, "RGBA")
+
+class Quantizer:
+    # Maps RGB frames to a fixed palette. With dither the error diffusion is left to Pillow's
+    # Floyd-Steinberg, which gives the same frames as before. Without it every pixel is looked
+    # up in a table of the nearest palette colour, built once per palette.
+    def __init__(self, palette, dither=True):
+        self.palette = list(palette)
+        self.colors = np.asarray(self.palette, dtype=np.int32).reshape(-1, 3)
+        self.dither = dither
+        self.palette_image = Image.new("P", (1, 1))
+        self.palette_image.putpalette(self.palette)
+        self._lut = None
+
+    def lut(self):
+        if self._lut is None:
+            levels = 1 << LUT_BITS
+            step = 256 // levels
+            centers = np.arange(levels, dtype=np.int32) * step + step // 2
+            r, g, b = np.meshgrid(centers, centers, centers, indexing="ij")
+            rgb = np.stack([r, g, b], axis=-1).reshape(-1, 1, 3)
+            self._lut = ((rgb - self.colors) ** 2).sum(axis=-1).argmin(axis=-1).astype(np.uint8)
+        return self._lut
+
+    def quantize(self, image: Image.Image, output_palette=None):
+        if self.dither:
+            out = image.convert("RGB").quantize(len(self.colors), palette=self.palette_image)
+        else:
+            rgb = np.asarray(image.convert("RGB")) >> (8 - LUT_BITS)
+            idx = (rgb[..., 0].astype(np.int32) << (2 * LUT_BITS)) | (rgb[..., 1].astype(np.int32) << LUT_BITS) | rgb[..., 2]
+            out = Image.fromarray(self.lut()[idx], "L")
+            out.putpalette(self.palette)
+        if output_palette is not None:
+            out.putpalette(output_palette)
+        return out
+
+    def render(self, base: Image.Image, text_image: Image.Image, output_palette=None):
+        # Text on top of the base, mapped to the palette
+        return self.quantize(composite_text(base, text_image), output_palette)
+
+
+if __name__ == "__main__":
+    # Compare against the old composite + convert + quantize path on a synthetic frame
+    import time
+    from PIL import ImageDraw
+
+    desat = [0x1c, 0x18, 0x1c, 0xff, 0xff, 0xff, 0xe7, 0xde, 0x23, 0xcd, 0x24, 0x25, 0x1e, 0x1d, 0xae, 0x1d, 0xad, 0x23]
+    rng = np.random.default_rng(0)
+    base = Image.fromarray(rng.integers(0, 256, (480, 800, 3), dtype=np.uint8), "RGB")
+    text_image = Image.new("P", (800, 480), color="#111111")
+    text_d = ImageDraw.Draw(text_image)
+    for i in range(40):
+        text_d.text((10 + (i % 4) * 190, 10 + (i // 4) * 45), f"Event {i} lunch möte", fill=["#000000", "#FF0000", "#0000FF", "#00FF00"][i % 4])
+
+    def old_path():
+        palette_image = Image.new("P", (1, 1))
+        palette_image.putpalette(desat)
+        out = Image.composite(base, text_image.convert("RGBA"), text_image.convert("L").point(lambda x: 255 if x == 17 else 0))
+        return out.convert("RGB").quantize(6, palette=palette_image)
+
+    def bench(name, fn, runs=10):
+        fn()
+        start = time.perf_counter()
+        for _ in range(runs):
+            result = fn()
+        print(f"{name}: {(time.perf_counter() - start) / runs * 1000:.1f} ms")
+        return result
+
+    old = bench("old composite + quantize", old_path)
+    dithered = Quantizer(desat)
+    new = bench("numpy composite + dithered quantize", lambda: dithered.render(base, text_image))
+    print("identical to old path:", old.tobytes() == new.tobytes())
+    plain = Quantizer(desat, dither=False)
+    plain.lut()
+    bench("numpy composite + lookup table", lambda: plain.render(base, text_image))
@@ -0,0 +1,58 @@
+import datetime
+import holidays
+import json
+import locale
+import os
+
+DAY_INFO_DIR = "cache/days"
+
+# Built once per (year, locale) and kept on disk, the views only look days up
+_years = {}
+
+
+def build_year(year):
+    sweden = holidays.Sweden(years=year)
+    table = {}
+    date = datetime.date(year, 1, 1)
+    while date.year == year:
+        week_label = date.strftime(f"%A {date.strftime('%d').lstrip('0')} %B").capitalize()
+        if date.day == 13 and date.isoweekday() == 5:
+            week_label = "Fredagen den 13:e " + date.strftime("%B")
+        table[date.isoformat()] = {
+            "red_day": date.isoweekday() == 7 or date in sweden,
+            "holiday": sweden.get(date),
+            "week": date.isocalendar().week,
+            "month_label": date.strftime("%a %d").capitalize(),
+            "week_label": week_label,
+        }
+        date += datetime.timedelta(days=1)
+    return table
+
+def load_year(year):
+    time_locale = locale.setlocale(locale.LC_TIME)
+    key = (year, time_locale)
+    if key in _years:
+        return _years[key]
+
+    path = os.path.join(DAY_INFO_DIR, f"{year}-{time_locale}.json")
+    table = None
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data["holidays_version"] == holidays.__version__:
+            table = data["days"]
+    except (OSError, json.JSONDecodeError, KeyError):
+        pass
+
+    if table is None:
+        table = build_year(year)
+        os.makedirs(DAY_INFO_DIR, exist_ok=True)
+        with open(path + f".{os.getpid()}.tmp", "w") as f:
+            json.dump({"holidays_version": holidays.__version__, "days": table}, f)
+        os.replace(path + f".{os.getpid()}.tmp", path)
+
+    _years[key] = table
+    return table
+
+def day_info(date: datetime.date):
+    return load_year(date.year)[date.isoformat()]
@@ -0,0 +1,117 @@
+from PIL import Image
+import json
+import numpy
+import os
+import time
+import metrics
+
+# KALENDAR_DISPLAY=fake writes frames to FAKE_DISPLAY_DIR instead of driving the panel, so the
+# whole refresh can run and be timed without an Inky attached
+DISPLAY_ENV = "KALENDAR_DISPLAY"
+FAKE_DISPLAY_DIR = "cache/display"
+FAKE_DISPLAY_FRAMES = 50  # frames kept by the fake panel, oldest are removed first
+FAKE_DISPLAY_REFRESH = 0  # seconds a fake refresh takes, to mimic the real panel
+
+# The driver's native colour code for each index of a frame's palette (black, white, yellow,
+# red, blue, green, the order of the palettes in draw_cal), by driver module. These are the
+# codes the drivers' own set_image writes into buf. Other drivers go through set_image.
+NATIVE_COLOURS = {
+    "inky.inky_e673": [0, 1, 2, 3, 5, 6],
+    "inky.inky_e640": [0, 1, 2, 3, 5, 6],
+    "inky.inky_el133uf1": [0, 1, 2, 3, 5, 6],
+    "inky.inky_uc8159": [0, 1, 5, 4, 3, 2],
+}
+
+
+def changed_region(previous: Image.Image, image: Image.Image):
+    # (left, top, right, bottom) of the pixels that differ, None if nothing did
+    if previous is None or previous.size != image.size or previous.mode != image.mode or previous.getpalette() != image.getpalette():
+        return (0, 0) + image.size
+    diff = numpy.asarray(previous) != numpy.asarray(image)
+    if diff.ndim == 3:
+        diff = diff.any(axis=2)
+    rows, cols = numpy.nonzero(diff.any(axis=1))[0], numpy.nonzero(diff.any(axis=0))[0]
+    if not len(rows):
+        return None
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+
+class InkyBackend:
+    # The Spectra 6 and UC8159 drivers always refresh the whole panel
+    supports_partial = False
+
+    def __init__(self, inky=None):
+        self.inky = inky
+
+    def _panel(self):
+        if self.inky is None:
+            from inky.auto import auto # pyright: ignore[reportMissingImports]
+            self.inky = auto(ask_user=True, verbose=True)
+        return self.inky
+
+    def show(self, image: Image.Image, region=None):
+        inky = self._panel()
+        buf = getattr(inky, "buf", None)
+        native = NATIVE_COLOURS.get(type(inky).__module__)
+        indices = numpy.asarray(image) if image.mode == "P" and native else None
+        if indices is not None and buf is not None and indices.shape == buf.shape:
+            # Already quantized, map the palette indices to the driver's colour codes in one
+            # lookup instead of letting set_image quantize and map them again
+            inky.buf = numpy.array(native, dtype=buf.dtype)[indices]
+            metrics.count("display.direct_buffer")
+        else:
+            inky.set_image(image)
+        inky.show()
+
+
+class FakeBackend:
+    # Writes every frame it is shown as a PNG and logs how long each update took to display.jsonl
+    supports_partial = True
+
+    def __init__(self, directory=FAKE_DISPLAY_DIR, max_frames=FAKE_DISPLAY_FRAMES, refresh_seconds=FAKE_DISPLAY_REFRESH):
+        self.directory = directory
+        self.max_frames = max_frames
+        self.refresh_seconds = refresh_seconds
+
+    def show(self, image: Image.Image, region=None):
+        start = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"frame-{time.time():.3f}.png"
+        image.save(os.path.join(self.directory, name), format="PNG", compress_level=1)
+        if self.refresh_seconds:
+            time.sleep(self.refresh_seconds)
+        ms = (time.perf_counter() - start) * 1000
+
+        entry = {"ts": round(time.time(), 3), "frame": name, "region": region, "ms": round(ms, 2)}
+        with open(os.path.join(self.directory, "display.jsonl"), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        self._prune()
+
+    def _prune(self):
+        frames = sorted(name for name in os.listdir(self.directory) if name.startswith("frame-") and name.endswith(".png"))
+        for name in frames[:max(0, len(frames) - self.max_frames)]:
+            os.remove(os.path.join(self.directory, name))
+
+
+class Display:
+    # Sends frames to a backend, with only the changed region when the backend can do partial updates
+    def __init__(self, backend):
+        self.backend = backend
+        self.previous = None
+
+    def show(self, image: Image.Image, force=False):
+        region = None
+        if self.backend.supports_partial:
+            region = (0, 0) + image.size if force else changed_region(self.previous, image)
+            if region is None:
+                metrics.count("display.unchanged")
+                return
+            if region != (0, 0) + image.size:
+                metrics.count("display.partial_updates")
+        self.backend.show(image, region)
+        self.previous = image
+
+def get_display(inky=None):
+    if os.environ.get(DISPLAY_ENV) == "fake":
+        return Display(FakeBackend())
+    return Display(InkyBackend(inky))
@@ -1,15 +1,23 @@
-from icalevents import icalevents
-import csv
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
+from typing import NamedTuple
 import calendar
 import datetime
 import locale
-import holidays
 import random
 import os
-from hyphen import Hyphenator, textwrap2
 import json
-from weather import CalWeather
+from weather import CalWeather, forecast_provider, prewarm_fonts as weather_prewarm_fonts
+from calendars import EventIndex, load_events
+from day_info import day_info
+from fingerprint import events_fingerprint, forecast_fingerprint, input_fingerprint, load_render_state
+from fonts import get_font, prewarm
+from compositor import Quantizer, text_layer
+from frames import FrameCache
+from layers import LayerCache
+import metrics
+from wallpapers import WallpaperCache
+from text_bitmaps import draw_outlined_text, draw_text
+from text_layout import fit_text, save_wrap_cache, wrap_text
 
 # Constants for calendar layout
 IMG_WIDTH = 800
@@ -20,9 +28,28 @@ CAL_W = 800 - CAL_X * 2
 CAL_H = 395
 MAX_EVENTS = 5
 BG_OPACITY = 0  # 0-255
-FONT = ImageFont.truetype("font/dejavu-sans/ttf/DejaVuSans.ttf", index=0, encoding="unic", layout_engine="raqm", size=12)
-LARGE_FONT = ImageFont.truetype("font/dejavu-sans/ttf/DejaVuSansCondensed.ttf", index=0, encoding="unic", layout_engine="raqm", size=21)
-SYMBOL_FONT = ImageFont.truetype("font/dejavu-sans/ttf/DejaVuSans.ttf", index=0, encoding="unic", layout_engine="raqm", size=12)
+LOCALE = "sv_SE.UTF-8"
+VIEWS = ["month", "week"]  # also the views prerender() keeps ready for the buttons
+CLOCK_FORMAT = "%H:%M"  # None hides the clock, the clock is part of what decides if the screen changed
+EVENT_WINDOW_MARGIN = datetime.timedelta(days=1)  # slack around the visible days for timezone edges
+DITHER = True  # Floyd-Steinberg when mapping to the display palette, off uses a faster nearest-colour table
+PREMAP_WALLPAPERS = False  # cache wallpapers already dithered to the display palette, changes how they look
+FONT_PATH = "font/dejavu-sans/ttf/DejaVuSans.ttf"
+LARGE_FONT_PATH = "font/dejavu-sans/ttf/DejaVuSansCondensed.ttf"
+SYMBOL_FONT_PATH = "font/dejavu-sans/ttf/DejaVuSans.ttf"
+MONTH_FONT_PATH = "font/Libre_Baskerville/LibreBaskerville-Italic.ttf"
+
+def regular_font(size=12):
+    return get_font(FONT_PATH, size, layout_engine="raqm")
+
+def large_font():
+    return get_font(LARGE_FONT_PATH, 21, layout_engine="raqm")
+
+def symbol_font():
+    return get_font(SYMBOL_FONT_PATH, 12, layout_engine="raqm")
+
+def month_font():
+    return get_font(MONTH_FONT_PATH, 60)
 
 c_black = "#000000"
 c_white = "#FFFFFF"
@@ -45,128 +72,132 @@ SAT_PALETTE = [ 0, 0, 0,
                 255, 0, 0, 
                 0, 0, 255, 
                 0, 255, 0]
-
-def draw_text_with_bg(d, text_d, text, x, y, font, fill=c_black, bg_color=c_white, padding=1, antialias=False):
+# Output palettes by name, "desaturated" is roughly what the panel looks like
+PALETTES = {"saturated": SAT_PALETTE, "desaturated": DESAT_PALETTE}
+
+class Theme(NamedTuple):
+    background: str = c_white
+    weekday: str = c_black
+    weeknum: str = c_red
+    month: str = c_white
+    month_outline: str = c_black
+    lines: str = c_white
+    today_box: str = c_red
+    red_day: str = c_red
+
+DEFAULT_THEME = Theme()
+
+class RenderProfile(NamedTuple):
+    # How a panel is drawn, so one process can render for several panels
+    theme: Theme = DEFAULT_THEME
+    locale: str = LOCALE
+    dither: bool = DITHER
+
+PROFILES = {
+    "default": RenderProfile(),
+    "fast": RenderProfile(dither=False),  # nearest-colour quantization, about twice as fast
+}
+
+# persist: keep the rendered text on disk too, for labels that stay the same all month
+def draw_text_with_bg(d, text_d, text, x, y, font, fill=c_black, bg_color=c_white, padding=1, antialias=False, persist=False):
     text_draw = d if antialias else text_d
 
     length_px = text_draw.textlength(text, font=font)
     bbox = (x, y, x + length_px + padding * 2, y + font.size + padding * 2)
     d.rounded_rectangle(bbox, radius=3, fill=bg_color)
-    text_draw.text((x + padding, y + padding), text, font=font, fill=fill)
-
-def draw_text_with_outline(d, text_d, text, x, y, font, fill=c_black, outline_color=c_white, outline_width=1, anchor="lt"):
-    # Draw outline
-    for dx in [-outline_width, 0, outline_width]:
-        for dy in [-outline_width, 0, outline_width]:
-            if dx != 0 or dy != 0:
-                text_d.text((x + dx, y + dy), text, font=font, fill=outline_color, anchor=anchor)
-    # Draw main text
-    text_d.text((x, y), text, font=font, fill=fill, anchor=anchor)
-
-def get_todays_events(events, date: datetime.date):
-    todays_events = []
-    multiday_event_days = {}
-
-    # Grab multiday events
-    for event, color in events:
-        if event.start.date() <= date <= event.end.date() and not event.start.date() == event.end.date() and not event.all_day:
-            event_len = (event.end.date() - event.start.date()).days + 1
-            event_day = (date - event.start.date()).days + 1
-            event_day = f"({event_day}/{event_len})"
-            multiday_event_days[event] = event_day
-            todays_events.append((event, color))
-        
-    todays_oneday_events = [e for e in events if e[0].start.date() == date and not e[0] in multiday_event_days.keys()]
-    todays_oneday_events.sort(key=lambda x: x[0].start)
-    todays_events.extend(todays_oneday_events)
+    draw_text(text_draw, (x + padding, y + padding), text, font, fill, persist=persist)
 
-    return todays_events, multiday_event_days
+def draw_text_with_outline(d, text_d, text, x, y, font, fill=c_black, outline_color=c_white, outline_width=1, anchor="lt", persist=False):
+    # The outline and the text on top, from one cached rendering
+    draw_outlined_text(text_d, (x, y), text, font, fill, outline_color, outline_width, anchor=anchor, persist=persist)
 
 class DrawCalendarDay:
-    def __init__(self, x, y, w, h, date: datetime.date):
+    def __init__(self, x, y, w, h, date: datetime.date, theme: "Theme" = None):
         self.x = x
         self.y = y
         self.w = w
         self.h = h
         self.date = date 
+        self.theme = theme or DEFAULT_THEME
+
+    def draw(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw, events: EventIndex, weather: CalWeather):
+        self.draw_static(d, text_d)
+        self.draw_dynamic(d, text_d, events, weather)
 
-    def draw(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw, events: list[tuple[icalevents.Event, str]], weather: CalWeather):
+    def draw_static(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw):
         x1, y1 = self.x, self.y
         x2, y2 = self.x + self.w, self.y + self.h
-        d.rectangle([x1, y1, x2, y2], outline=lines_color, width=1)
+        d.rectangle([x1, y1, x2, y2], outline=self.theme.lines, width=1)
 
         
         # Draw date
-        date_str = self.date.strftime("%a %d").capitalize()
-        is_red_day = self.date.isoweekday() == 7 or self.date in holidays.Sweden()
-        draw_text_with_bg(d, text_d, date_str, x1 + 3, y1 + 3, FONT, fill=weekday_color if not is_red_day else red_day_color, bg_color=c_white, padding=1)
+        info = day_info(self.date)
+        date_str = info["month_label"]
+        is_red_day = info["red_day"]
+        draw_text_with_bg(d, text_d, date_str, x1 + 3, y1 + 3, regular_font(), fill=self.theme.weekday if not is_red_day else self.theme.red_day, bg_color=c_white, padding=1, persist=True)
 
 
         # Draw week number if it's Monday
         if self.date.isoweekday() == 1:
-            week_str = "v. " + str(self.date.isocalendar().week)
-            draw_text_with_bg(d, text_d, week_str, x2 - text_d.textlength(week_str, font=FONT)-5, y1 + 3, FONT, fill=weeknum_color, bg_color=c_white, padding=1)
-            
+            week_str = "v. " + str(info["week"])
+            draw_text_with_bg(d, text_d, week_str, x2 - text_d.textlength(week_str, font=regular_font())-5, y1 + 3, regular_font(), fill=self.theme.weeknum, bg_color=c_white, padding=1, persist=True)
+
+    def draw_dynamic(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw, events: EventIndex, weather: CalWeather):
+        # Returns False if an event box spilled into the next cell
+        x1, y1 = self.x, self.y
+        x2, y2 = self.x + self.w, self.y + self.h
+        contained = True
+
         # Draw events
         
-        todays_events, multiday_event_days = get_todays_events(events, self.date)
+        todays_events, multiday_event_days = events.get_todays_events(self.date)
 
         events_today = len(todays_events)
         if events_today > MAX_EVENTS:
             todays_events = todays_events[:MAX_EVENTS-1]
 
         line_idx = 0
-        for (event, color) in (todays_events):
+        for event in todays_events:
+            color = event.color
             line_idx += 1
 
             # draw bullet point
             bp = "★" if color == "#00FF00" else "❤" if color == "#FF0000" else "*"
-            bp_w = text_d.textlength(bp, font=SYMBOL_FONT)
+            bp_w = text_d.textlength(bp, font=symbol_font())
 
-            event_text = ""
             if event in multiday_event_days.keys():
-                event_text = event.summary
-                days_string = multiday_event_days[event]
-                unacceptable_textlen = lambda text: text_d.textlength(text + "…" + days_string, font=FONT) > self.w - (bp_w)
-                # unacceptable_textlen = lambda text: False
-                if unacceptable_textlen(event_text):
-                    while unacceptable_textlen(event_text):
-                        event_text = event_text[:-1]
-                    event_text += "…" + days_string
-                else:
-                    event_text += " " + days_string
+                event_text = fit_text(text_d, event.summary, regular_font(), self.w - (bp_w), suffix=multiday_event_days[event])
             else:
                 event_text = f"{event.start.astimezone().strftime('%H')} {event.summary}" if not event.all_day else event.summary
-                unacceptable_textlen = lambda text: text_d.textlength(text + "…", font=FONT) > self.w - (bp_w)
-                # unacceptable_textlen = lambda text: False
-                if unacceptable_textlen(event_text):
-                    while unacceptable_textlen(event_text):
-                        event_text = event_text[:-1]
-                    event_text += "…"
+                event_text = fit_text(text_d, event_text, regular_font(), self.w - (bp_w))
             
-            length = text_d.textlength(event_text, font=FONT)
+            length = text_d.textlength(event_text, font=regular_font())
             bbox = (x1 + 2, y1 +3+ (12 * (line_idx)), min(x1 + 2 + length + bp_w, x2-1), y1 + (12 * (line_idx+1)) +4)
             d.rounded_rectangle(bbox,radius=3, fill=c_white)
-            text_d.text((x1+2, y1 +4+ (12 * (line_idx)) - 2), bp, font=SYMBOL_FONT, fill=color)
-            text_d.text((x1 + 2+bp_w, y1 +3+ (12 * (line_idx))), event_text, fill=c_black, font=FONT)
+            contained = contained and bbox[3] < y2
+            text_d.text((x1+2, y1 +4+ (12 * (line_idx)) - 2), bp, font=symbol_font(), fill=color)
+            text_d.text((x1 + 2+bp_w, y1 +3+ (12 * (line_idx))), event_text, fill=c_black, font=regular_font())
 
         if  events_today > MAX_EVENTS:
-            draw_text_with_bg(d, text_d, f"+{events_today - MAX_EVENTS} till härligheter…", x1 + 2, y2 - 10-2, FONT.font_variant(size=10), fill=lines_color, bg_color=c_white, padding=0)
+            draw_text_with_bg(d, text_d, f"+{events_today - MAX_EVENTS} till härligheter…", x1 + 2, y2 - 10-2, regular_font(10), fill=self.theme.lines, bg_color=c_white, padding=0)
         
         if not self.date.isoweekday() == 1:
             weather_img = weather.get_micro_image(18,18, self.date)
             d._image.paste(weather_img, (int(x2 - (18+3)), int(y1+(3))), weather_img)
+        return contained
 
 class DrawCalendar:
-    def __init__(self, x, y, w, h):
+    def __init__(self, x, y, w, h, today: datetime.date = None, forecast=None, theme: "Theme" = None):
         self.x = x
         self.y = y
         self.w = w
         self.h = h
+        self.today = today or datetime.date.today()
+        self.theme = theme or DEFAULT_THEME
         self.locale_cal = calendar.LocaleTextCalendar(calendar.MONDAY, "sv-se")
-        self.weather = CalWeather()
+        self.weather = CalWeather(forecast)
 
-        monthdates = self.locale_cal.monthdatescalendar(datetime.date.today().year, datetime.date.today().month)
+        monthdates = self.locale_cal.monthdatescalendar(self.today.year, self.today.month)
 
         self.week_num = len(monthdates)
         self.day_width = w / 7
@@ -183,11 +214,16 @@ class DrawCalendar:
                     w=self.day_width,
                     h=self.week_height,
                     date=date,
+                    theme=self.theme,
                 ))
             self.days_grid.append(week_row)
 
-    def draw(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw, events):
-        # Draw background
+    def static_key(self):
+        # Grid, day labels and title only change with the month
+        return ["month", self.today.strftime("%Y-%m")]
+
+    def draw(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw, events: EventIndex):
+        # Everything in one pass, day by day, for renders that can't use the cached static layer
         d.rectangle([self.x, self.y, self.x + self.w, self.y + self.h], fill=f"rgba(255,255,255,{BG_OPACITY})")
 
         for week in self.days_grid:
@@ -195,35 +231,65 @@ class DrawCalendar:
                 day.draw(d,text_d, events, self.weather)
         for week_row in self.days_grid:
             for day in week_row:
-                if day.date == datetime.date.today():
-                    d.rectangle([day.x, day.y, day.x+day.w, day.y+day.h], outline=today_box_color, width=2)
+                if day.date == self.today:
+                    d.rectangle([day.x, day.y, day.x+day.w, day.y+day.h], outline=self.theme.today_box, width=2)
+
+        self.draw_title(d, text_d)
+
+    def draw_static(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw):
+        # Draw background
+        d.rectangle([self.x, self.y, self.x + self.w, self.y + self.h], fill=f"rgba(255,255,255,{BG_OPACITY})")
+
+        for week in self.days_grid:
+            for day in week:
+                day.draw_static(d, text_d)
+        self.draw_title(d, text_d)
 
-        month_name = datetime.date.today().strftime("%B %Y").capitalize()
-        month_font = ImageFont.truetype("font/Libre_Baskerville/LibreBaskerville-Italic.ttf", 60)
+    def draw_title(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw):
+        month_name = self.today.strftime("%B %Y").capitalize()
         # text_d.text((400, 5), month_name, font=month_font, fill=month_color, anchor="mt")
-        draw_text_with_outline(d, text_d, month_name, self.x + self.w / 2, 5, month_font, fill=month_color, outline_color=month_outline_color, outline_width=1, anchor="mt")
+        draw_text_with_outline(d, text_d, month_name, self.x + self.w / 2, 5, month_font(), fill=self.theme.month, outline_color=self.theme.month_outline, outline_width=1, anchor="mt", persist=True)
+
+    def draw_dynamic(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw, events: EventIndex):
+        # Returns False if a day spilled over a later day, which the static layer would then draw over
+        contained = True
+        for week in self.days_grid:
+            for day in week:
+                contained = day.draw_dynamic(d, text_d, events, self.weather) and contained
+        for week_row in self.days_grid:
+            for day in week_row:
+                if day.date == self.today:
+                    d.rectangle([day.x, day.y, day.x+day.w, day.y+day.h], outline=self.theme.today_box, width=2)
+        return contained
 
 class DrawWeekDay:
-    def __init__(self, x, y, w, h, date: datetime.date):
+    def __init__(self, x, y, w, h, date: datetime.date, theme: "Theme" = None):
         self.x = x
         self.y = y
         self.w = w
         self.h = h
         self.date = date
+        self.theme = theme or DEFAULT_THEME
 
-    def draw(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw, events, weather: CalWeather):
-        d.rectangle([self.x, self.y, self.x + self.w, self.y + self.h], outline=lines_color, width=1)
-        date_str = self.date.strftime(f"%A {self.date.strftime('%d').lstrip('0')} %B").capitalize()
-        if self.date.day == 13 and self.date.isoweekday() == 5:
-            date_str = "Fredagen den 13:e " + self.date.strftime("%B")
+    def draw(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw, events: EventIndex, weather: CalWeather):
+        self.draw_static(d, text_d)
+        self.draw_dynamic(d, text_d, events, weather)
 
-        is_red_day = self.date.isoweekday() == 7 or self.date in holidays.Sweden()
-        draw_text_with_bg(d, text_d, date_str, self.x + 3, self.y + 3, FONT, fill=weekday_color if not is_red_day else red_day_color, bg_color=c_white, padding=1)
+    def draw_static(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw):
+        d.rectangle([self.x, self.y, self.x + self.w, self.y + self.h], outline=self.theme.lines, width=1)
+        info = day_info(self.date)
+        date_str = info["week_label"]
+        is_red_day = info["red_day"]
+        draw_text_with_bg(d, text_d, date_str, self.x + 3, self.y + 3, regular_font(), fill=self.theme.weekday if not is_red_day else self.theme.red_day, bg_color=c_white, padding=1, persist=True)
 
-        todays_events, multiday_event_days = get_todays_events(events, self.date)
+    def draw_dynamic(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw, events: EventIndex, weather: CalWeather):
+        # Returns False if a line spilled into the next cell
+        todays_events, multiday_event_days = events.get_todays_events(self.date)
+        contained = True
 
         line_idx = 0
-        for event, color in todays_events:
+        for event in todays_events:
+            color = event.color
             bp = "★" if color == "#00FF00" else "❤" if color == "#FF0000" else "*"
 
             event_text = event.summary
@@ -236,82 +302,113 @@ class DrawWeekDay:
         
             event_text = bp  + event_text
 
-            wrapped_lines = []
-
-            max_width = int(self.w)
-            min_width = 5  # Avoid too small widths that break hyphenator
-            hyphenator = Hyphenator("sv_SE")
-            best_lines = []
-            # Binary search for the largest width that fits
-            while min_width <= max_width:
-                mid_width = (min_width + max_width) // 2
-                # Avoid widths that are too small for hyphenator
-                if mid_width < 5:
-                    break
-                try:
-                    wrapped_lines = textwrap2.wrap(event_text, max_lines=4, width=mid_width, break_long_words=True, use_hyphenator=hyphenator)
-                    lines_good = all([text_d.textlength(line, font=LARGE_FONT) <= self.w for line in wrapped_lines])
-                except Exception:
-                    # If hyphenator fails, treat as not good
-                    lines_good = False
-                    wrapped_lines = []
-                if lines_good:
-                    best_lines = wrapped_lines
-                    min_width = mid_width + 1
-                else:
-                    max_width = mid_width - 1
-            wrapped_lines = best_lines if best_lines else [event_text]
+            wrapped_lines = wrap_text(text_d, event_text, large_font(), self.w, max_lines=4)
 
             for line in wrapped_lines:
                 line_idx += 1
-                draw_text_with_bg(d, text_d, line, self.x + 2, self.y + 3 + (LARGE_FONT.size * (line_idx)), LARGE_FONT, fill=color, bg_color=c_white, padding=0, antialias=True)
-            text_d.text((self.x + 2, self.y + 3 + (LARGE_FONT.size * (line_idx))), line, fill=color, font=LARGE_FONT)
+                draw_text_with_bg(d, text_d, line, self.x + 2, self.y + 3 + (large_font().size * (line_idx)), large_font(), fill=color, bg_color=c_white, padding=0, antialias=True)
+                contained = contained and self.y + 3 + (large_font().size * (line_idx + 1)) < self.y + self.h and self.x + 2 + d.textlength(line, font=large_font()) < self.x + self.w
+            text_d.text((self.x + 2, self.y + 3 + (large_font().size * (line_idx))), line, fill=color, font=large_font())
 
         weather_img = weather.get_micro_image(26,26, self.date, color="color")
         d._image.paste(weather_img, (int(self.x+self.w - (26+3)), int(self.y-(2))), weather_img)
+        return contained
 
 class DrawWeek:
-    def __init__(self, x, y, w, h):
+    def __init__(self, x, y, w, h, today: datetime.date = None, forecast=None, theme: "Theme" = None):
         self.x = x
         self.y = y
         self.w = w
         self.h = h
-        self.weather = CalWeather()
+        self.today = today or datetime.date.today()
+        self.theme = theme or DEFAULT_THEME
+        self.weather = CalWeather(forecast)
 
-    def draw(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw, events):
-        # Draw background
-        d.rectangle([self.x, self.y, self.x + self.w, self.y + self.h], fill=f"rgba(255,255,255,{BG_OPACITY})")
-
-        # Draw day boxes, in a 4x2 grid
-        day_width = self.w / 4
-        day_height = self.h / 2
+        # Day boxes in a 4x2 grid, the first box is for the weather
+        self.day_width = self.w / 4
+        self.day_height = self.h / 2
 
+        self.days: list[DrawWeekDay] = []
         for i in range(1,8):
-            day_x = self.x + (i % 4) * day_width
-            day_y = self.y + (i // 4) * day_height
-            day = DrawWeekDay(
+            day_x = self.x + (i % 4) * self.day_width
+            day_y = self.y + (i // 4) * self.day_height
+            self.days.append(DrawWeekDay(
                 x=day_x,
                 y=day_y,
-                w=day_width,
-                h=day_height,
-                date=datetime.date.today() + datetime.timedelta(days=i-1)
-            )
-            day.draw(d, text_d, events, self.weather)
-        
+                w=self.day_width,
+                h=self.day_height,
+                date=self.today + datetime.timedelta(days=i-1),
+                theme=self.theme,
+            ))
+
+    def static_key(self):
+        return ["week", self.today.isoformat()]
+
+    def draw(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw, events: EventIndex):
+        # Everything in one pass, day by day, for renders that can't use the cached static layer
+        d.rectangle([self.x, self.y, self.x + self.w, self.y + self.h], fill=f"rgba(255,255,255,{BG_OPACITY})")
+
+        for day in self.days:
+            day.draw(d,text_d, events, self.weather)
+        self.draw_weather(d)
+
+    def draw_static(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw):
+        # Draw background
+        d.rectangle([self.x, self.y, self.x + self.w, self.y + self.h], fill=f"rgba(255,255,255,{BG_OPACITY})")
+
+        for day in self.days:
+            day.draw_static(d, text_d)
+
+    def draw_dynamic(self, d: ImageDraw.ImageDraw, text_d: ImageDraw.ImageDraw, events: EventIndex):
+        # Returns False if a day spilled over a later day, which the static layer would then draw over
+        contained = True
+        for day in self.days:
+            contained = day.draw_dynamic(d, text_d, events, self.weather) and contained
+        self.draw_weather(d)
+        return contained
+
+    def draw_weather(self, d: ImageDraw.ImageDraw):
         #draw weather
-        weather_img = self.weather.get_image(int(day_width), int(day_height))
+        weather_img = self.weather.get_image(int(self.day_width), int(self.day_height))
         d._image.paste(weather_img, (int(self.x), int(self.y)), weather_img)
-        d.rectangle([self.x, self.y, self.x+day_width, self.y+day_height], outline=lines_color)
+        d.rectangle([self.x, self.y, self.x+self.day_width, self.y+self.day_height], outline=self.theme.lines)
+
+def prewarm_fonts():
+    prewarm([
+        (FONT_PATH, [10, 12], "raqm"),
+        (LARGE_FONT_PATH, [21], "raqm"),
+        (SYMBOL_FONT_PATH, [12], "raqm"),
+        (MONTH_FONT_PATH, [60], None),
+    ])
+    weather_prewarm_fonts()
+
+def view_window(option, today: datetime.date):
+    # First and last date shown by the view
+    if option == "week":
+        return today, today + datetime.timedelta(days=6)
+    monthdates = calendar.Calendar(calendar.MONDAY).monthdatescalendar(today.year, today.month)
+    return monthdates[0][0], monthdates[-1][-1]
+
+def choose_wallpaper(option, seed):
+    # Seeded so the same inputs keep the same wallpaper and an unchanged screen can be skipped
+    image_folder = "photos" if option == "week" else "wallpapers"
+    return random.Random(seed).choice(wallpaper_cache.images(image_folder))
 
-def setup_image(option):
+layer_cache = LayerCache()
+frame_cache = FrameCache()
+quantizer = Quantizer(DESAT_PALETTE, dither=DITHER)
+quantizers = {DITHER: quantizer}
+
+def get_quantizer(dither):
+    if dither not in quantizers:
+        quantizers[dither] = Quantizer(DESAT_PALETTE, dither=dither)
+    return quantizers[dither]
+wallpaper_cache = WallpaperCache((IMG_WIDTH, IMG_HEIGHT), palette=DESAT_PALETTE if PREMAP_WALLPAPERS else None)
+
+def setup_image(wallpaper):
     ImageDraw.ImageDraw.fontmode = "1"
     
-    image_folder = "photos" if option == "week" else "wallpapers"
-    wallpapers = [f for f in os.listdir(image_folder) if f.endswith((".jpg", ".png"))]
-    random_wallpaper = random.choice(wallpapers)
-    out = Image.open(os.path.join(image_folder, random_wallpaper)).convert("RGB")
-
-    out = out.resize((IMG_WIDTH, IMG_HEIGHT))
+    out = wallpaper_cache.load(wallpaper)
 
     text_image = Image.new("P", (IMG_WIDTH, IMG_HEIGHT), color="#111111")
     text_d = ImageDraw.Draw(text_image)
@@ -319,30 +416,7 @@ def setup_image(option):
     d = ImageDraw.Draw(out, "RGBA")
     return out, d, text_image, text_d
 
-def draw_image():
-    global background_color, weekday_color, weeknum_color, month_color, month_outline_color, lines_color, today_box_color, red_day_color
-    background_color = c_white
-    weekday_color = c_black
-    weeknum_color = c_red
-    month_color = c_white
-    month_outline_color = c_black
-    lines_color = c_white
-    today_box_color = c_red
-    red_day_color = c_red
-
-    locale.setlocale(locale.LC_ALL, "sv_SE.UTF-8")
-    
-
-    events: list[tuple[icalevents.Event, str]] = []
-    with open("calendars.csv", "r") as csvfile:
-        reader = csv.reader(csvfile)
-        reader.__next__()
-        for row in reader:
-            fix_apple = row[3].startswith("webcal://")
-            es = icalevents.events(row[3], start=datetime.date.today() - datetime.timedelta(weeks=52), end=datetime.date.today() + datetime.timedelta(weeks=52), fix_apple=fix_apple)
-            es = [(e, row[2]) for e in es]
-            events.extend(es)
-
+def read_option():
     if os.path.exists("draw.json"):
         with open("draw.json", "r") as f:
             data = json.load(f)
@@ -350,30 +424,138 @@ def draw_image():
     else:
         option = ""
 
-    if option not in ["month", "week"]:
+    if option not in VIEWS:
         option = "month"
         with open("draw.json", "w") as f:
             json.dump({"draw_option": "month"}, f)
+    return option
+
+def load_render_data(options, today: datetime.date):
+    # One fetch of events and forecast covering every view in options
+    windows = [view_window(option, today) for option in options]
+    return load_window_data(min(w[0] for w in windows), max(w[1] for w in windows))
+
+def load_window_data(start: datetime.date, end: datetime.date):
+    # Events shown anywhere from start to end and the current forecast
+    with metrics.stage("feeds"):
+        es = load_events(start=start - EVENT_WINDOW_MARGIN, end=end + datetime.timedelta(days=1) + EVENT_WINDOW_MARGIN)
+    metrics.count("events.loaded", len(es))
+    with metrics.stage("forecast"):
+        forecast = forecast_provider.get_forecast()
+    return es, forecast
+
+def draw_image(skip_unchanged=False, now: datetime.datetime = None):
+    # now pins the date and clock, e.g. for benchmarks, and defaults to the current time
+    now = now or datetime.datetime.now()
+    option = read_option()
+    es, forecast = load_render_data([option], now.date())
+    return render_view(option, es, forecast, now, skip_unchanged=skip_unchanged)
+
+def prerender(now: datetime.datetime = None, options=VIEWS, data=None):
+    # Renders every view from one fetch and keeps the frames, so switching views can skip the render.
+    # Views whose inputs haven't changed since their cached frame are not drawn again.
+    # data: (events, forecast) from load_render_data() covering options, fetched if not given
+    now = now or datetime.datetime.now()
+    es, forecast = data or load_render_data(options, now.date())
+    frames = {}
+    for i, option in enumerate(options):
+        try:
+            with metrics.stage("view", view=option):
+                frames[option] = render_view(option, es, forecast, now, reuse_cached=True)
+        except Exception as e:
+            # Only the first view is needed right now, the others can wait for the next refresh
+            if i == 0:
+                raise
+            print(f"Could not prerender {option}: {e!r}")
+            continue
+        if "cached" in frames[option].info:
+            frame_cache.touch(option, now)
+        else:
+            frame_cache.put(option, frames[option], now)
+    return frames
+
+def view_content(option, es, forecast, today: datetime.date):
+    # Everything the view shows except the clock: returns the EventIndex, the wallpaper and
+    # their fingerprint, which the scheduler compares to decide if a poll needs a redraw
+    start, end = view_window(option, today)
+    with metrics.stage("index"):
+        events = EventIndex(es, start=start, end=end)
+
+    data_fingerprint = input_fingerprint(
+        option=option,
+        today=today,
+        events=events_fingerprint(events, start, end),
+        forecast=forecast_fingerprint(forecast, option, start, end),
+    )
+    wallpaper = choose_wallpaper(option, data_fingerprint)
+    return events, wallpaper, input_fingerprint(data=data_fingerprint, wallpaper=wallpaper)
+
+def render_view(option, es, forecast, now: datetime.datetime, skip_unchanged=False, reuse_cached=False, profile: RenderProfile = None, palette=SAT_PALETTE):
+    # Draws one view for now from already loaded events and forecast. Apart from the caches it
+    # only depends on its arguments, see render.py for rendering any date without the panel.
+    profile = profile or PROFILES["default"]
+    locale.setlocale(locale.LC_ALL, profile.locale)
+    today = now.date()
+    theme = profile.theme
+
+    events, wallpaper, content = view_content(option, es, forecast, today)
+    clock = now.strftime(CLOCK_FORMAT) if CLOCK_FORMAT else None
+    fingerprint = input_fingerprint(content=content, clock=clock, profile=profile, palette=palette)
+    if skip_unchanged and fingerprint == load_render_state().get("inputs"):
+        return None
+    if reuse_cached:
+        cached = frame_cache.get(option, fingerprint)
+        if cached is not None:
+            metrics.count("frames.reused")
+            return cached
 
-    out, d, text_image, text_d = setup_image(option)
     if option == "month":
-        cal = DrawCalendar(CAL_X, CAL_Y, CAL_W, CAL_H)
-        cal.draw(d,text_d, events)
+        cal = DrawCalendar(CAL_X, CAL_Y, CAL_W, CAL_H, today, forecast, theme)
     elif option == "week":
-        cal = DrawWeek(20, 20, IMG_WIDTH - 40, IMG_HEIGHT - 40)
-        cal.draw(d,text_d, events)
+        cal = DrawWeek(20, 20, IMG_WIDTH - 40, IMG_HEIGHT - 40, today, forecast, theme)
+
+    # The wallpaper, grid and date labels only change with the day or month, so they are drawn
+    # once into cached layers and only events, weather and the clock are drawn on every render
+    static_key = cal.static_key() + [
+        wallpaper, os.path.getmtime(wallpaper), PREMAP_WALLPAPERS, BG_OPACITY, locale.setlocale(locale.LC_TIME),
+        *theme,
+    ]
+    with metrics.stage("static"):
+        layers = layer_cache.get(static_key, ["base", "text"])
+        if layers is None:
+            base, d, text_image, text_d = setup_image(wallpaper)
+            cal.draw_static(d, text_d)
+            layers = {"base": base, "text": text_layer(text_image)}
+            layer_cache.put(static_key, layers)
 
-    # draw current time
-    draw_text_with_bg(d, text_d, datetime.datetime.now().strftime("%H:%M"),0,0,FONT)
-            
-
-    palette_image = Image.new("P", (1, 1))
-    palette_image.putpalette(DESAT_PALETTE)
+    ImageDraw.ImageDraw.fontmode = "1"
+    out = layers["base"].copy()
+    d = ImageDraw.Draw(out, "RGBA")
+    text_image = Image.new("P", (IMG_WIDTH, IMG_HEIGHT), color="#111111")
+    text_d = ImageDraw.Draw(text_image)
 
-    out = Image.composite(out, text_image.convert("RGBA"), text_image.convert("L").point(lambda x: 255 if x == 17 else 0)) #17 is #111111, the bg of text image
-    out = out.convert("RGB")
-    out = out.quantize(6, palette=palette_image)
-    out.putpalette(SAT_PALETTE)
+    with metrics.stage("dynamic"):
+        layered = cal.draw_dynamic(d, text_d, events)
+        if not layered:
+            # Something overflowed its cell, draw everything in the original order so the later
+            # cells' borders and labels end up on top of it like before
+            metrics.count("render.overflow_redraws")
+            out, d, text_image, text_d = setup_image(wallpaper)
+            cal.draw(d, text_d, events)
+        if option == "week":
+            save_wrap_cache()
+
+        # draw current time
+        if clock:
+            draw_text_with_bg(d, text_d, clock,0,0,regular_font())
+
+        if layered:
+            out.paste(layers["text"], (0, 0), layers["text"])
+
+    with metrics.stage("quantize"):
+        out = get_quantizer(profile.dither).render(out, text_image, output_palette=palette)
+    out.info["fingerprint"] = fingerprint
+    out.info["content"] = content
 
     return out
 
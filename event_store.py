@@ -0,0 +1,194 @@
+from icalevents import icalevents
+import datetime
+import hashlib
+import os
+import sqlite3
+import metrics
+
+EVENT_STORE_FILE = "cache/events.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS feeds (
+    url TEXT PRIMARY KEY,
+    feed_hash TEXT NOT NULL,
+    header_hash TEXT NOT NULL,
+    window_start TEXT NOT NULL,
+    window_end TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS groups (
+    url TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (url, uid)
+);
+CREATE TABLE IF NOT EXISTS occurrences (
+    url TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    all_day INTEGER NOT NULL,
+    summary TEXT NOT NULL,
+    start_day TEXT NOT NULL,
+    end_day TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS occurrences_group ON occurrences (url, uid);
+CREATE INDEX IF NOT EXISTS occurrences_days ON occurrences (url, start_day, end_day);
+"""
+
+
+def _hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _unfold(lines):
+    # Continuation lines start with a space or tab
+    unfolded = []
+    for line in lines:
+        if line[:1] in (" ", "\t") and unfolded:
+            unfolded[-1] += line[1:]
+        else:
+            unfolded.append(line)
+    return unfolded
+
+def split_feed(content: str):
+    # Splits a calendar into its header (everything but the VEVENTs, i.e. timezones and
+    # calendar properties) and the VEVENT blocks grouped by UID, so a recurring event and its
+    # RECURRENCE-ID overrides stay together. Returns (header_lines, {uid: [block_lines, ...]}, group hashes).
+    lines = content.replace("\r", "").split("\n")
+    header, groups, block = [], {}, None
+    for line in lines:
+        if line == "BEGIN:VEVENT":
+            block = [line]
+        elif block is not None:
+            block.append(line)
+            if line == "END:VEVENT":
+                unfolded = _unfold(block)
+                uid = next((l.split(":", 1)[1] for l in unfolded if l.startswith(("UID:", "UID;"))), None)
+                # DTSTAMP changes on every download from some servers, everything else counts
+                # (SEQUENCE, LAST-MODIFIED, RRULE, EXDATE, the summary, ...)
+                signature = "\n".join(l for l in unfolded if not l.startswith(("DTSTAMP:", "DTSTAMP;")))
+                groups.setdefault(uid or "no-uid:" + _hash(signature), []).append((block, signature))
+                block = None
+        else:
+            header.append(line)
+    hashes = {uid: _hash("\n".join(signature for _, signature in blocks)) for uid, blocks in groups.items()}
+    return header, {uid: [b for b, _ in blocks] for uid, blocks in groups.items()}, hashes
+
+def group_calendar(header, blocks):
+    # The header with just this group's VEVENTs, right before the last END:VCALENDAR
+    end = max(i for i, line in enumerate(header) if line == "END:VCALENDAR")
+    return "\n".join(header[:end] + [line for block in blocks for line in block] + header[end:])
+
+class EventStore:
+    # Expanded occurrences of every feed, per VEVENT UID, in SQLite. When a feed changes only
+    # the UIDs whose VEVENTs changed are expanded again, and UIDs that are gone are deleted.
+    # Everything is expanded again if the timezones/calendar properties change or the
+    # requested window isn't covered.
+    def __init__(self, path=EVENT_STORE_FILE):
+        self.path = path
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Transactions are opened explicitly, and WAL keeps readers from waiting on a writer
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+    def sync(self, url, feed: bytes, start: datetime.date, end: datetime.date, prefetch_days=0, fix_apple=False):
+        feed_hash = hashlib.sha256(feed).hexdigest()
+        conn = self._connect()
+        try:
+            while True:
+                row = conn.execute("SELECT feed_hash, header_hash, window_start, window_end FROM feeds WHERE url = ?", (url,)).fetchone()
+                covered = row is not None and row[2] <= start.isoformat() and end.isoformat() <= row[3]
+                if covered and row[0] == feed_hash:
+                    metrics.count("feeds.parse_cache_hits")
+                    return
+
+                header, groups, hashes = split_feed(feed.decode("utf-8"))
+                if header.count("BEGIN:VCALENDAR") != 1 or "END:VCALENDAR" not in header:
+                    # Not a single plain calendar, treat the whole feed as one group
+                    header, groups, hashes = None, {"*": None}, {"*": feed_hash}
+                header_hash = _hash("\n".join(header or []))
+
+                reuse = covered and row[1] == header_hash
+                if reuse:
+                    window_start, window_end = datetime.date.fromisoformat(row[2]), datetime.date.fromisoformat(row[3])
+                    stored = dict(conn.execute("SELECT uid, hash FROM groups WHERE url = ?", (url,)).fetchall())
+                else:
+                    window_start = start - datetime.timedelta(days=prefetch_days)
+                    window_end = end + datetime.timedelta(days=prefetch_days)
+                    stored = {}
+
+                # Expand outside any transaction, so other feeds can write their results meanwhile
+                changed = [uid for uid in groups if stored.get(uid) != hashes[uid]]
+                metrics.count("events.groups_reused", len(groups) - len(changed))
+                metrics.count("events.groups_expanded", len(changed))
+                expanded = {}
+                with metrics.stage("feed.parse", groups=len(changed)):
+                    for uid in changed:
+                        content = feed if header is None else group_calendar(header, groups[uid])
+                        es = icalevents.events(string_content=content, start=window_start, end=window_end, fix_apple=fix_apple)
+                        metrics.count("events.parsed", len(es))
+                        expanded[uid] = [(url, uid, seq, e.start.isoformat(), e.end.isoformat(), int(e.all_day), e.summary or "", e.start.date().isoformat(), e.end.date().isoformat())
+                                         for seq, e in enumerate(es)]
+
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    if conn.execute("SELECT feed_hash, header_hash, window_start, window_end FROM feeds WHERE url = ?", (url,)).fetchone() != row:
+                        # Another process synced this feed while we were expanding, start over from its result
+                        conn.execute("ROLLBACK")
+                        continue
+                    if not reuse:
+                        conn.execute("DELETE FROM groups WHERE url = ?", (url,))
+                        conn.execute("DELETE FROM occurrences WHERE url = ?", (url,))
+                    for uid in stored.keys() - groups.keys():
+                        conn.execute("DELETE FROM groups WHERE url = ? AND uid = ?", (url, uid))
+                        conn.execute("DELETE FROM occurrences WHERE url = ? AND uid = ?", (url, uid))
+                    for uid, rows in expanded.items():
+                        conn.execute("DELETE FROM occurrences WHERE url = ? AND uid = ?", (url, uid))
+                        conn.executemany(
+                            "INSERT INTO occurrences (url, uid, seq, start, end, all_day, summary, start_day, end_day) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            rows,
+                        )
+
+                    # Keep feed order, so events come back in the order they are in the feed
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO groups (url, uid, hash, position) VALUES (?, ?, ?, ?)",
+                        [(url, uid, hashes[uid], position) for position, uid in enumerate(groups)],
+                    )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO feeds (url, feed_hash, header_hash, window_start, window_end) VALUES (?, ?, ?, ?, ?)",
+                        (url, feed_hash, header_hash, window_start.isoformat(), window_end.isoformat()),
+                    )
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                return
+        finally:
+            conn.close()
+
+    def covers(self, url, start: datetime.date, end: datetime.date):
+        # Whether the last sync of url expanded every day of start..end
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT window_start, window_end FROM feeds WHERE url = ?", (url,)).fetchone()
+        finally:
+            conn.close()
+        return row is not None and row[0] <= start.isoformat() and end.isoformat() <= row[1]
+
+    def query(self, url, start: datetime.date, end: datetime.date):
+        # (start, end, all_day, summary) of every occurrence touching start..end, in feed order
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT o.start, o.end, o.all_day, o.summary FROM occurrences o JOIN groups g ON g.url = o.url AND g.uid = o.uid "
+                "WHERE o.url = ? AND o.start_day <= ? AND o.end_day >= ? ORDER BY g.position, o.seq",
+                (url, end.isoformat(), start.isoformat()),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [(datetime.datetime.fromisoformat(s), datetime.datetime.fromisoformat(e), bool(all_day), summary) for s, e, all_day, summary in rows]
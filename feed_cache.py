@@ -0,0 +1,135 @@
+import hashlib
+import json
+import metrics
+import os
+import time
+import urllib.error
+import urllib.request
+
+FEED_CACHE_DIR = "cache/feeds"
+FEED_MAX_AGE = 60 * 60 * 24 * 7  # seconds a cached feed may be served when the network is down
+FEED_MAX_SIZE = 20 * 1024 * 1024  # bytes of feed bodies kept on disk
+FEED_TIMEOUT = 20  # seconds
+
+
+def feed_url(url):
+    # webcal:// is just http:// with a different name, same fix as icalevents' fix_apple
+    if url.startswith("webcal://"):
+        url = url.replace("webcal://", "http://", 1)
+    return url
+
+
+class FeedCache:
+    def __init__(self, directory=FEED_CACHE_DIR, max_age=FEED_MAX_AGE, max_size=FEED_MAX_SIZE, timeout=FEED_TIMEOUT):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_size = max_size
+        self.timeout = timeout
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key + ".ics"), os.path.join(self.directory, key + ".json")
+
+    def _write(self, path, data):
+        tmp_path = path + f".{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def load(self, url):
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except (OSError, json.JSONDecodeError):
+            return None, {}
+        return body, meta
+
+    def store(self, url, body, meta):
+        os.makedirs(self.directory, exist_ok=True)
+        body_path, meta_path = self._paths(url)
+        self._write(body_path, body)
+        self._write(meta_path, json.dumps(meta).encode("utf-8"))
+        self.evict()
+
+    def touch(self, url, meta):
+        meta["fetched"] = time.time()
+        _, meta_path = self._paths(url)
+        self._write(meta_path, json.dumps(meta).encode("utf-8"))
+
+    def is_fresh(self, meta):
+        return time.time() - meta.get("fetched", 0) <= self.max_age
+
+    def fetch(self, url):
+        body, meta = self.load(url)
+
+        request = urllib.request.Request(feed_url(url), headers={"User-Agent": "kalendar"})
+        if body is not None:
+            if meta.get("etag"):
+                request.add_header("If-None-Match", meta["etag"])
+            if meta.get("last_modified"):
+                request.add_header("If-Modified-Since", meta["last_modified"])
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                new_body = response.read()
+                new_meta = {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "fetched": time.time(),
+                }
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and body is not None:
+                metrics.count("feeds.not_modified")
+                self.touch(url, meta)
+                return body
+            if body is not None and self.is_fresh(meta):
+                metrics.count("feeds.served_cached")
+                return body
+            raise
+        except OSError:
+            # Covers URLError, timeouts and refused connections
+            if body is not None and self.is_fresh(meta):
+                metrics.count("feeds.served_cached")
+                return body
+            raise
+
+        if not new_body:
+            raise ConnectionError(f"Could not get data from {url}!")
+
+        metrics.count("feeds.downloaded")
+        self.store(url, new_body, new_meta)
+        return new_body
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            meta_path = os.path.join(self.directory, name)
+            body_path = meta_path[:-len(".json")] + ".ics"
+            try:
+                with open(meta_path, "r") as f:
+                    fetched = json.load(f).get("fetched", 0)
+                size = os.path.getsize(body_path)
+            except (OSError, json.JSONDecodeError):
+                fetched, size = 0, 0
+            entries.append((fetched, size, body_path, meta_path))
+
+        # Drop expired feeds, then the least recently fetched until we fit,
+        # but never the feed that was just stored
+        entries.sort()
+        total = sum(size for _, size, _, _ in entries)
+        now = time.time()
+        for fetched, size, body_path, meta_path in entries[:-1]:
+            if total <= self.max_size and now - fetched <= self.max_age:
+                continue
+            for path in (body_path, meta_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
@@ -0,0 +1,58 @@
+import datetime
+import hashlib
+import json
+import os
+from PIL import Image
+from calendars import EventIndex
+from translations import translate
+
+RENDER_STATE_FILE = "cache/render_state.json"
+
+
+def _hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def _dates(start: datetime.date, end: datetime.date):
+    return [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+
+def events_fingerprint(events: EventIndex, start: datetime.date, end: datetime.date):
+    normalized = []
+    for date in _dates(start, end):
+        todays_events, multiday_event_days = events.get_todays_events(date)
+        normalized.append([
+            date.isoformat(),
+            [[event.start.isoformat(), event.end.isoformat(), event.all_day, event.summary, event.color, multiday_event_days.get(event)] for event in todays_events],
+        ])
+    return _hash(normalized)
+
+def forecast_fingerprint(forecast, option, start: datetime.date, end: datetime.date):
+    # Only the parts of the forecast the view draws
+    days = {date.isoformat() for date in _dates(start, end)}
+    fields = {"daily": [[pfc.day.strftime("%Y-%m-%d"), pfc.icon] for pfc in forecast.daily if pfc.day.strftime("%Y-%m-%d") in days]}
+    if option == "week":
+        # The translated summary, so the screen is redrawn once a background translation arrives
+        fields["current"] = [forecast.current.icon_num, round(forecast.current.temperature), translate(forecast.current.summary)]
+        fields["hourly"] = [[forecast.hourly[i].date.strftime("%H"), forecast.hourly[i].icon, round(forecast.hourly[i].temperature)] for i in (3, 6, 9, 12)]
+    return _hash(fields)
+
+def input_fingerprint(**inputs):
+    return _hash(inputs)
+
+def frame_hash(image: Image.Image):
+    h = hashlib.sha256(image.tobytes())
+    if image.mode == "P":
+        h.update(bytes(image.getpalette() or []))
+    return h.hexdigest()
+
+def load_render_state():
+    try:
+        with open(RENDER_STATE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def save_render_state(inputs, frame, content=None):
+    os.makedirs(os.path.dirname(RENDER_STATE_FILE) or ".", exist_ok=True)
+    with open(RENDER_STATE_FILE + f".{os.getpid()}.tmp", "w") as f:
+        json.dump({"inputs": inputs, "frame": frame, "content": content}, f)
+    os.replace(RENDER_STATE_FILE + f".{os.getpid()}.tmp", RENDER_STATE_FILE)
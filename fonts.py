@@ -0,0 +1,24 @@
+from PIL import ImageFont
+import threading
+
+# Every (path, size, layout engine) is loaded once, on first use, and kept for the life of the process
+_fonts = {}
+_lock = threading.Lock()
+
+
+def get_font(path, size, layout_engine=None):
+    key = (path, size, layout_engine)
+    font = _fonts.get(key)
+    if font is None:
+        with _lock:
+            font = _fonts.get(key)
+            if font is None:
+                font = ImageFont.truetype(path, size=size, layout_engine=layout_engine)
+                _fonts[key] = font
+    return font
+
+def prewarm(specs):
+    # specs: iterable of (path, sizes, layout_engine)
+    for path, sizes, layout_engine in specs:
+        for size in sizes:
+            get_font(path, size, layout_engine)
@@ -0,0 +1,88 @@
+from PIL import Image
+import datetime
+import json
+import os
+import time
+
+FRAME_CACHE_DIR = "cache/frames"
+FRAME_MAX_AGE = 60 * 60  # seconds a pre-rendered frame may be shown on a button press
+
+
+class FrameCache:
+    # The last finished palette frame of every view, keyed by view and input fingerprint.
+    # Each view has a small json entry pointing at its PNG, so the refresh job and the button
+    # daemon can share frames without stepping on each other.
+    def __init__(self, directory=FRAME_CACHE_DIR, max_age=FRAME_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        self.memory = {}
+
+    def _entry(self, view):
+        try:
+            with open(os.path.join(self.directory, f"{view}.json"), "r") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _open(self, view, entry):
+        cached = self.memory.get(view)
+        if cached is not None and cached.info.get("fingerprint") == entry["fingerprint"]:
+            return cached
+        try:
+            with Image.open(os.path.join(self.directory, entry["file"])) as im:
+                im.load()
+        except OSError:
+            return None
+        im.info["fingerprint"] = entry["fingerprint"]
+        im.info["content"] = entry.get("content")
+        im.info["cached"] = True
+        self.memory[view] = im
+        return im
+
+    def get(self, view, fingerprint):
+        entry = self._entry(view)
+        if entry is None or entry["fingerprint"] != fingerprint:
+            return None
+        return self._open(view, entry)
+
+    def latest(self, view, today: datetime.date):
+        # The frame from the last refresh, if it is from today and recent enough to show as is
+        entry = self._entry(view)
+        if entry is None or entry["date"] != today.isoformat() or time.time() - entry["rendered"] > self.max_age:
+            return None
+        return self._open(view, entry)
+
+    def content(self, view):
+        # The clock-less content fingerprint of the view's frame, see draw_cal.view_content
+        entry = self._entry(view)
+        return entry and entry.get("content")
+
+    def touch(self, view, now: datetime.datetime):
+        # The cached frame is still what the view looks like now
+        entry = self._entry(view)
+        if entry is not None:
+            self._write_entry(view, dict(entry, date=now.date().isoformat(), rendered=time.time()))
+
+    def _write_entry(self, view, entry):
+        path = os.path.join(self.directory, f"{view}.json")
+        with open(path + f".{os.getpid()}.tmp", "w") as f:
+            json.dump(entry, f)
+        os.replace(path + f".{os.getpid()}.tmp", path)
+
+    def put(self, view, image: Image.Image, now: datetime.datetime):
+        os.makedirs(self.directory, exist_ok=True)
+        fingerprint = image.info["fingerprint"]
+        file = f"{view}-{fingerprint[:16]}.png"
+        image.save(os.path.join(self.directory, file + f".{os.getpid()}.tmp"), format="PNG", compress_level=1)
+        os.replace(os.path.join(self.directory, file + f".{os.getpid()}.tmp"), os.path.join(self.directory, file))
+
+        previous = self._entry(view)
+        self._write_entry(view, {"fingerprint": fingerprint, "content": image.info.get("content"), "file": file, "date": now.date().isoformat(), "rendered": time.time()})
+        if previous and previous["file"] != file:
+            try:
+                os.remove(os.path.join(self.directory, previous["file"]))
+            except FileNotFoundError:
+                pass
+        cached = image.copy()
+        cached.info["cached"] = True
+        self.memory[view] = cached
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from PIL import Image
+import hashlib
+import json
+import metrics
+import os
+
+LAYER_CACHE_DIR = "cache/layers"
+LAYER_MEMORY_SIZE = 4  # layer sets kept in memory by long-running processes
+LAYER_DISK_SIZE = 32  # layer sets kept on disk, oldest are removed first
+
+
+class LayerCache:
+    # Layers that only change with their key (view, date or month, wallpaper, colours, ...),
+    # stored as PNGs named after a hash of the key
+    def __init__(self, directory=LAYER_CACHE_DIR, memory_size=LAYER_MEMORY_SIZE, disk_size=LAYER_DISK_SIZE):
+        self.directory = directory
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory = OrderedDict()
+
+    def _key(self, key):
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, key, names):
+        key = self._key(key)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            metrics.count("layers.memory_hits")
+            return self.memory[key]
+
+        layers = {}
+        try:
+            for name in names:
+                with Image.open(os.path.join(self.directory, f"{key}-{name}.png")) as im:
+                    im.load()
+                    layers[name] = im
+        except OSError:
+            metrics.count("layers.misses")
+            return None
+
+        metrics.count("layers.disk_hits")
+        self._remember(key, layers)
+        return layers
+
+    def put(self, key, layers):
+        key = self._key(key)
+        os.makedirs(self.directory, exist_ok=True)
+        for name, im in layers.items():
+            path = os.path.join(self.directory, f"{key}-{name}.png")
+            im.save(path + f".{os.getpid()}.tmp", format="PNG", compress_level=1)
+            os.replace(path + f".{os.getpid()}.tmp", path)
+        self._remember(key, layers)
+        self._evict()
+
+    def _remember(self, key, layers):
+        self.memory[key] = layers
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _evict(self):
+        files = {}
+        for name in os.listdir(self.directory):
+            if name.endswith(".png"):
+                path = os.path.join(self.directory, name)
+                key = name.split("-")[0]
+                files.setdefault(key, []).append((os.path.getmtime(path), path))
+        keys = sorted(files, key=lambda k: max(files[k]))
+        for key in keys[:max(0, len(keys) - self.disk_size)]:
+            for _, path in files[key]:
+                os.remove(path)
@@ -0,0 +1,113 @@
+from contextlib import contextmanager, nullcontext
+from logging.handlers import RotatingFileHandler
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+# KALENDAR_METRICS=1 logs the wall time of every render stage, KALENDAR_METRICS=memory also
+# traces the peak Python memory of each stage (slower, and the feed threads share one peak).
+# Off, stage() and count() do nothing.
+METRICS_ENV = "KALENDAR_METRICS"
+METRICS_LOG_FILE = "cache/metrics.jsonl"
+METRICS_LOG_SIZE = 1024 * 1024  # bytes per log file before it is rotated
+METRICS_LOG_BACKUPS = 3
+
+enabled = False
+trace_memory = False
+listeners = []  # callables that get every record, e.g. the benchmark
+
+_logger = None
+_local = threading.local()
+_counters = {}
+_counters_lock = threading.Lock()
+_off = nullcontext()
+
+
+def enable(log_file=METRICS_LOG_FILE, memory=False):
+    global enabled, trace_memory, _logger
+    enabled = True
+    trace_memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if log_file and _logger is None:
+        os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+        _logger = logging.getLogger("kalendar.metrics")
+        _logger.propagate = False
+        _logger.setLevel(logging.INFO)
+        handler = RotatingFileHandler(log_file, maxBytes=METRICS_LOG_SIZE, backupCount=METRICS_LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _logger.addHandler(handler)
+
+def disable():
+    global enabled, trace_memory
+    enabled = False
+    if trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    trace_memory = False
+
+def emit(record):
+    record = {"ts": round(time.time(), 3), **record}
+    if _logger is not None:
+        _logger.info(json.dumps(record, default=str))
+    for listener in listeners:
+        listener(record)
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+@contextmanager
+def _stage(name, fields):
+    stack = _stack()
+    entry = {"name": name, "peak": 0}
+    if trace_memory:
+        # Nested stages share the tracemalloc peak, so hand what we have so far to the parent first
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    stack.append(entry)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        ms = (time.perf_counter() - start) * 1000
+        stack.pop()
+        record = {"stage": "/".join([e["name"] for e in stack] + [name]), "ms": round(ms, 2), **fields}
+        if trace_memory:
+            peak = max(entry["peak"], tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            record["peak_kib"] = peak // 1024
+        else:
+            record["max_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        emit(record)
+
+def stage(name, **fields):
+    # with stage("feeds"): ... logs how long the block took, nested stages are logged as "outer/inner"
+    if not enabled:
+        return _off
+    return _stage(name, fields)
+
+def count(name, n=1):
+    if enabled:
+        with _counters_lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+def emit_counters(**fields):
+    # Logs and resets the counters, once per refresh
+    if not enabled:
+        return
+    with _counters_lock:
+        counters = dict(_counters)
+        _counters.clear()
+    emit({"counters": counters, **fields})
+
+
+if os.environ.get(METRICS_ENV, "0") not in ("", "0"):
+    enable(memory=os.environ[METRICS_ENV] == "memory")
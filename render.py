@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Headless rendering of any date, view, palette and profile, without the panel or draw.json.
+# Many frames are rendered across a process pool that shares one load of events and forecast:
+#
+#   python render.py --from 2025-01-01 --to 2025-12-31 --view month --view week --out frames/
+#   python render.py --date 2025-03-12 --view week --profile fast --raw --out frames/
+import argparse
+import datetime
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+import draw_cal
+
+RENDER_TIME = datetime.time(12, 0)  # the clock on frames rendered for a date
+RENDER_WORKERS = os.cpu_count() or 1
+
+
+class RenderJob(NamedTuple):
+    date: datetime.date
+    view: str = "month"
+    palette: str = "saturated"
+    profile: str = "default"
+
+    def filename(self, raw=False):
+        name = f"{self.date.isoformat()}-{self.view}"
+        if self.palette != "saturated":
+            name += f"-{self.palette}"
+        if self.profile != "default":
+            name += f"-{self.profile}"
+        return name + (".raw" if raw else ".png")
+
+def load_data(jobs):
+    # Events covering every job's view window and the current forecast, loaded once for all jobs
+    windows = [draw_cal.view_window(job.view, job.date) for job in jobs]
+    return draw_cal.load_window_data(min(w[0] for w in windows), max(w[1] for w in windows))
+
+def render(job: RenderJob, data=None, now: datetime.datetime = None):
+    # The job's frame as a palette image. now overrides the clock, which otherwise shows RENDER_TIME.
+    if job.view not in draw_cal.VIEWS:
+        raise ValueError(f"Unknown view {job.view!r}, expected one of {draw_cal.VIEWS}")
+    es, forecast = data or load_data([job])
+    now = now or datetime.datetime.combine(job.date, RENDER_TIME)
+    return draw_cal.render_view(job.view, es, forecast, now, profile=draw_cal.PROFILES[job.profile], palette=draw_cal.PALETTES[job.palette])
+
+def to_buffer(image):
+    # Palette indices in the frame's palette order, one byte per pixel row by row. The Inky's
+    # buffer has the same shape but holds the driver's colour codes, see display.NATIVE_COLOURS
+    return image.tobytes()
+
+def save(image, path, raw=False):
+    if raw:
+        with open(path + f".{os.getpid()}.tmp", "wb") as f:
+            f.write(to_buffer(image))
+        os.replace(path + f".{os.getpid()}.tmp", path)
+    else:
+        image.save(path, format="PNG")
+
+_shared_data = None
+
+def _init_worker(data):
+    global _shared_data
+    _shared_data = data
+    draw_cal.prewarm_fonts()
+
+def _render_to_file(job, out_dir, raw):
+    path = os.path.join(out_dir, job.filename(raw))
+    save(render(job, _shared_data), path, raw)
+    return path
+
+def render_many(jobs, out_dir, raw=False, workers=RENDER_WORKERS, data=None):
+    # Renders every job into out_dir across a process pool and returns the paths in job order.
+    # Workers get the events and forecast loaded here instead of fetching their own.
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    os.makedirs(out_dir, exist_ok=True)
+    data = data or load_data(jobs)
+    if workers <= 1:
+        _init_worker(data)
+        return [_render_to_file(job, out_dir, raw) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(data,)) as executor:
+        # Neighbouring dates share static layers, so hand out runs of them rather than single jobs
+        return list(executor.map(_render_to_file, jobs, [out_dir] * len(jobs), [raw] * len(jobs), chunksize=max(1, len(jobs) // (workers * 4))))
+
+def date_range(start: datetime.date, end: datetime.date):
+    return [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Render calendar frames without the display")
+    parser.add_argument("--date", type=datetime.date.fromisoformat, action="append", default=[], help="date to render, can be repeated")
+    parser.add_argument("--from", dest="start", type=datetime.date.fromisoformat, help="first date of a range")
+    parser.add_argument("--to", dest="end", type=datetime.date.fromisoformat, help="last date of a range")
+    parser.add_argument("--view", action="append", choices=draw_cal.VIEWS, help="view to render, can be repeated (default month)")
+    parser.add_argument("--palette", action="append", choices=list(draw_cal.PALETTES), help="output palette, can be repeated (default saturated)")
+    parser.add_argument("--profile", action="append", choices=list(draw_cal.PROFILES), help="render profile, can be repeated (default default)")
+    parser.add_argument("--raw", action="store_true", help="write raw palette buffers instead of PNGs")
+    parser.add_argument("--out", default="frames", help="output directory (default frames)")
+    parser.add_argument("--workers", type=int, default=RENDER_WORKERS, help=f"worker processes (default {RENDER_WORKERS})")
+    args = parser.parse_args()
+
+    dates = list(args.date)
+    if args.start or args.end:
+        dates += date_range(args.start or args.end, args.end or args.start)
+    dates = dates or [datetime.date.today()]
+    jobs = [
+        RenderJob(date, view, palette, profile)
+        for profile in args.profile or ["default"]
+        for palette in args.palette or ["saturated"]
+        for view in args.view or ["month"]
+        for date in dates
+    ]
+    for path in render_many(jobs, args.out, raw=args.raw, workers=args.workers):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import datetime
+from weather import forecast_provider
+
+FEED_POLL_INTERVAL = 15 * 60  # seconds between feed polls, a poll only redraws when the view changed
+MIN_POLL_INTERVAL = 60  # seconds, keeps a failing forecast fetch from polling in a loop
+ROLLOVER_DELAY = 5  # seconds past midnight before the new day is drawn
+
+
+def next_rollover(day: datetime.date):
+    return datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()) + datetime.timedelta(seconds=ROLLOVER_DELAY)
+
+def next_forecast_poll(provider, now: datetime.datetime):
+    # The forecast is worth fetching again once it is stale and the next hourly bucket has
+    # started, before that the API hands back the same hours. A failed fetch waits a TTL too.
+    if provider.forecast is None:
+        return now
+    stale = datetime.datetime.fromtimestamp(provider.attempted + provider.ttl)
+    hourly = provider.forecast.hourly
+    local_now = now.astimezone()
+    for i in range(len(hourly)):
+        if hourly[i].date > local_now:
+            return max(stale, hourly[i].date.astimezone().replace(tzinfo=None))
+    return stale
+
+
+class RefreshScheduler:
+    # Works out when the screen could change next instead of redrawing on a fixed cadence.
+    # The date is the only thing that changes on its own, so the day rollover is a redraw.
+    # Feeds and forecast can change at any time and are polled, a poll only redraws if the
+    # view on screen would look different. The clock shows when the screen was last drawn.
+    def __init__(self, provider=forecast_provider, feed_poll_interval=FEED_POLL_INTERVAL):
+        self.provider = provider
+        self.feed_poll_interval = datetime.timedelta(seconds=feed_poll_interval)
+        self.day = None
+        self.last_poll = None
+
+    def wakes(self, now: datetime.datetime):
+        # When each reason to wake up is next due
+        wakes = {"rollover": next_rollover(self.day or now.date()), "forecast": next_forecast_poll(self.provider, now)}
+        wakes["feeds"] = self.last_poll + self.feed_poll_interval if self.last_poll else now
+        if self.last_poll:
+            # Polls fetch feeds and forecast alike, space them out
+            earliest = self.last_poll + datetime.timedelta(seconds=MIN_POLL_INTERVAL)
+            wakes["forecast"] = max(wakes["forecast"], earliest)
+        return wakes
+
+    def next_wake(self, now: datetime.datetime):
+        return min(self.wakes(now).values())
+
+    def seconds_until_wake(self, now: datetime.datetime):
+        return max(0.0, (self.next_wake(now) - now).total_seconds())
+
+    def due(self, now: datetime.datetime):
+        # "redraw" once the day has changed, "poll" when feeds or forecast are due, otherwise None
+        if self.day is not None and now.date() != self.day:
+            return "redraw"
+        wakes = self.wakes(now)
+        if wakes["feeds"] <= now or wakes["forecast"] <= now:
+            return "poll"
+        return None
+
+    def polled(self, now: datetime.datetime):
+        self.last_poll = now
+
+    def drawn(self, now: datetime.datetime):
+        # A full refresh fetches feeds and forecast too
+        self.day = now.date()
+        self.last_poll = now
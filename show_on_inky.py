@@ -1,21 +1,105 @@
 
-from inky.auto import auto # pyright: ignore[reportMissingImports]
+import datetime
+from display import get_display
 import draw_cal
+from fingerprint import frame_hash, load_render_state, save_render_state
+import metrics
 
 
-def show_on_inky(prev_image=None):
+PRERENDER = True  # render every view on each refresh so the buttons can switch without rendering
 
-    inky = auto(ask_user=True, verbose=True)
+
+def show_on_inky(prev_image=None, display=None, force=False, data=None):
+    # data: (events, forecast) already loaded for every view, e.g. by poll()
+    with metrics.stage("refresh"):
+        display = _show_on_inky(prev_image, display, force, data)
+    metrics.emit_counters()
+    return display
+
+def _show_on_inky(prev_image, display, force, data=None):
 
     try:
-        out = draw_cal.draw_image()
+        with metrics.stage("draw_image"):
+            if PRERENDER:
+                option = draw_cal.read_option()
+                frames = draw_cal.prerender(options=[option] + [view for view in draw_cal.VIEWS if view != option], data=data)
+                out = frames[option]
+            else:
+                out = draw_cal.draw_image(skip_unchanged=not force)
     except Exception as e:
         out = draw_cal.draw_error(str(e))
+
+    # Nothing that ends up on screen changed since the last refresh
+    if out is None:
+        metrics.count("refresh.skipped_unchanged")
+        return display
     
     if prev_image and out == prev_image:
-        return
-    inky.set_image(out)
-    inky.show()
+        return display
+
+    return show_frame(out, display, force)
+
+def show_frame(out, display=None, force=False):
+    frame = frame_hash(out)
+    if force or frame != load_render_state().get("frame"):
+        if display is None:
+            display = get_display()
+        with metrics.stage("display.show"):
+            display.show(out, force=force)
+    else:
+        metrics.count("refresh.skipped_same_frame")
+    save_render_state(out.info.get("fingerprint"), frame, out.info.get("content"))
+    return display
+
+def show_view(option, display=None):
+    # A button press: show the frame the last refresh rendered for this view, render only if there is none
+    out = draw_cal.frame_cache.latest(option, datetime.date.today()) if PRERENDER else None
+    if out is None:
+        return show_on_inky(display=display)
+    metrics.count("frames.shown_prerendered")
+    with metrics.stage("refresh", view=option, prerendered=True):
+        display = show_frame(out, display)
+    metrics.emit_counters()
+    return display
+
+def poll(display=None):
+    # A scheduled check: fetches feeds and forecast, but only redraws when the view on screen
+    # would look different apart from the clock. Pre-rendered views that changed are redrawn
+    # in the background, unchanged ones are kept fresh for the buttons.
+    with metrics.stage("poll"):
+        display = _poll(display)
+    metrics.emit_counters()
+    return display
+
+def _poll(display):
+    now = datetime.datetime.now()
+    option = draw_cal.read_option()
+    views = [option] + [view for view in draw_cal.VIEWS if view != option] if PRERENDER else [option]
+    try:
+        data = draw_cal.load_render_data(views, now.date())
+    except Exception as e:
+        print(f"Poll failed: {e!r}")
+        return display
+
+    changed = []
+    for view in views:
+        content = draw_cal.view_content(view, *data, now.date())[2]
+        shown = load_render_state().get("content") if view == option else draw_cal.frame_cache.content(view)
+        if content != shown:
+            changed.append(view)
+        elif PRERENDER:
+            draw_cal.frame_cache.touch(view, now)
+
+    if option in changed:
+        metrics.count("poll.redraws")
+        return _show_on_inky(None, display, False, data)
+    if changed:
+        try:
+            draw_cal.prerender(now, options=changed, data=data)
+        except Exception as e:
+            print(f"Could not prerender {changed}: {e!r}")
+    metrics.count("poll.unchanged")
+    return display
 
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+import numpy
+from PIL import Image
+from display import InkyBackend
+
+
+class FakeInky:
+    # Stands in for inky.inky_e673.Inky, a Spectra 6 panel
+    def __init__(self):
+        self.buf = numpy.zeros((480, 800), dtype=numpy.uint8)
+        self.shown = False
+
+    def set_image(self, image):
+        raise AssertionError("set_image should not be called for a known driver")
+
+    def show(self):
+        self.shown = True
+
+FakeInky.__module__ = "inky.inky_e673"
+
+
+def test_spectra6_buffer_holds_native_codes():
+    image = Image.new("P", (800, 480), 1)
+    image.putpalette([0, 0, 0, 255, 255, 255, 255, 255, 0, 255, 0, 0, 0, 0, 255, 0, 255, 0])
+    for index in range(6):
+        image.putpixel((index, 0), index)
+
+    inky = FakeInky()
+    InkyBackend(inky).show(image)
+
+    assert inky.shown
+    assert list(inky.buf[0, :6]) == [0, 1, 2, 3, 5, 6]
+    assert inky.buf[1, 0] == 1
@@ -0,0 +1,168 @@
+from collections import OrderedDict
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+from PIL.PngImagePlugin import PngInfo
+import hashlib
+import json
+import math
+import metrics
+import os
+from text_layout import font_key
+
+TEXT_BITMAP_MEMORY_SIZE = 8 * 1024 * 1024  # bytes of rendered text masks kept in memory
+TEXT_BITMAP_DIR = "cache/text"  # persisted strings, set to None to keep them in memory only
+TEXT_BITMAP_DISK_SIZE = 1024  # persisted strings kept on disk, oldest are removed first
+
+
+class TextBitmap:
+    # A rendered string: its mask (and outline mask, in the same frame) and where the frame
+    # goes relative to the integer draw position
+    __slots__ = ("mask", "outline", "offset")
+
+    def __init__(self, mask: Image.Image, offset, outline: Image.Image = None):
+        self.mask = mask
+        self.outline = outline
+        self.offset = offset
+
+    def size(self):
+        return self.mask.size[0] * self.mask.size[1] * (2 if self.outline else 1)
+
+
+class TextBitmapCache:
+    # Rasterizes a string once and turns later draws of it into bitmap pastes. The masks are
+    # drawn by ImageDraw.text itself, keyed by everything its getmask2 call depends on (text,
+    # font, font mode, anchor and the subpixel start), so the pixels are the same.
+    # Outlined text keeps all outline offsets merged into one mask, drawn before the fill.
+    # Strings drawn with persist=True, like the month's day labels, are also kept on disk.
+    def __init__(self, directory=TEXT_BITMAP_DIR, memory_size=TEXT_BITMAP_MEMORY_SIZE, disk_size=TEXT_BITMAP_DISK_SIZE):
+        self.directory = directory
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory = OrderedDict()
+        self.memory_used = 0
+
+    def _key(self, text, font, mode, anchor, start, outline_width):
+        return (text, font_key(font), mode, anchor, start, outline_width)
+
+    def _file(self, key):
+        return os.path.join(self.directory, hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest() + ".png")
+
+    def _load(self, key):
+        try:
+            with Image.open(self._file(key)) as im:
+                im.load()
+            offset = tuple(json.loads(im.info["offset"]))
+        except (OSError, KeyError, ValueError):
+            return None
+        os.utime(self._file(key))
+        if im.mode == "LA":
+            return TextBitmap(im.getchannel("L"), offset, im.getchannel("A"))
+        return TextBitmap(im, offset)
+
+    def _save(self, key, bitmap: TextBitmap):
+        os.makedirs(self.directory, exist_ok=True)
+        info = PngInfo()
+        info.add_text("offset", json.dumps(bitmap.offset))
+        im = Image.merge("LA", (bitmap.mask.convert("L"), bitmap.outline)) if bitmap.outline else bitmap.mask
+        path = self._file(key)
+        im.save(path + f".{os.getpid()}.tmp", format="PNG", pnginfo=info)
+        os.replace(path + f".{os.getpid()}.tmp", path)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".png")]
+        if len(files) <= self.disk_size:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.disk_size]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _remember(self, key, bitmap: TextBitmap):
+        self.memory[key] = bitmap
+        self.memory_used += bitmap.size()
+        while self.memory_used > self.memory_size and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_used -= evicted.size()
+
+    def get(self, text, font, mode, anchor, start, outline_width=0, persist=False):
+        key = self._key(text, font, mode, anchor, start, outline_width)
+        bitmap = self.memory.get(key)
+        if bitmap is not None:
+            self.memory.move_to_end(key)
+            metrics.count("text.bitmap_hits")
+            return bitmap
+
+        bitmap = self._load(key) if persist and self.directory else None
+        if bitmap is not None:
+            metrics.count("text.bitmap_disk_hits")
+        else:
+            metrics.count("text.bitmap_misses")
+            bitmap = self._render(text, font, mode, anchor, start)
+            if outline_width:
+                bitmap = self._outlined(bitmap, outline_width)
+            if persist and self.directory:
+                self._save(key, bitmap)
+        self._remember(key, bitmap)
+        return bitmap
+
+    def _render(self, text, font, mode, anchor, start):
+        # Draws the string with ImageDraw.text onto a blank canvas with a pixel of room around
+        # its bounding box (start can push it one pixel further), then crops to the ink. The
+        # origin stays positive, ImageDraw.text splits negative positions differently.
+        left, top, right, bottom = font.getbbox(text, mode, anchor=anchor)
+        origin = (max(0, -left) + 1, max(0, -top) + 1)
+        canvas = Image.new("L", (origin[0] + right + 2, origin[1] + bottom + 2), 0)
+        draw = ImageDraw.Draw(canvas)
+        draw.fontmode = mode
+        draw.text((origin[0] + start[0], origin[1] + start[1]), text, font=font, fill=255, anchor=anchor)
+        box = canvas.getbbox() or (0, 0, 0, 0)
+        return TextBitmap(canvas.crop(box), (box[0] - origin[0], box[1] - origin[1]))
+
+    def _outlined(self, bitmap: TextBitmap, outline_width):
+        # The mask shifted to every outline offset and merged, in a frame padded by the outline width
+        w, h = bitmap.mask.size
+        mask = bitmap.mask.convert("L")
+        outline = Image.new("L", (w + outline_width * 2, h + outline_width * 2), 0)
+        for dx in [-outline_width, 0, outline_width]:
+            for dy in [-outline_width, 0, outline_width]:
+                if dx != 0 or dy != 0:
+                    shifted = Image.new("L", outline.size, 0)
+                    shifted.paste(mask, (outline_width + dx, outline_width + dy))
+                    outline = ImageChops.lighter(outline, shifted)
+        fill = Image.new("L", outline.size, 0)
+        fill.paste(mask, (outline_width, outline_width))
+        return TextBitmap(fill, (bitmap.offset[0] - outline_width, bitmap.offset[1] - outline_width), outline)
+
+text_bitmap_cache = TextBitmapCache()
+
+def _cacheable(draw: ImageDraw.ImageDraw, text, font, xy):
+    # Single lines of FreeType text in a plain font mode, at a position whose integer part
+    # ImageDraw.text would take the same way
+    return isinstance(font, ImageFont.FreeTypeFont) and draw.fontmode in ("1", "L") and "\n" not in text and xy[0] >= 0 and xy[1] >= 0
+
+def draw_text(draw: ImageDraw.ImageDraw, xy, text, font, fill, anchor=None, persist=False):
+    # Same pixels as draw.text(xy, text, font=font, fill=fill, anchor=anchor)
+    if not _cacheable(draw, text, font, xy):
+        draw.text(xy, text, font=font, fill=fill, anchor=anchor)
+        return
+    start = (math.modf(xy[0])[0], math.modf(xy[1])[0])
+    bitmap = text_bitmap_cache.get(text, font, draw.fontmode, anchor or "la", start, persist=persist)
+    draw.bitmap((int(xy[0]) + bitmap.offset[0], int(xy[1]) + bitmap.offset[1]), bitmap.mask, fill=fill)
+
+def draw_outlined_text(draw: ImageDraw.ImageDraw, xy, text, font, fill, outline_color, outline_width=1, anchor=None, persist=False):
+    # Same pixels as drawing the text at every offset within outline_width in outline_color, then
+    # once more in fill on top. Antialiased masks blend, so they can't be merged and aren't cached.
+    if draw.fontmode != "1" or not _cacheable(draw, text, font, (xy[0] - outline_width, xy[1] - outline_width)):
+        for dx in [-outline_width, 0, outline_width]:
+            for dy in [-outline_width, 0, outline_width]:
+                if dx != 0 or dy != 0:
+                    draw.text((xy[0] + dx, xy[1] + dy), text, font=font, fill=outline_color, anchor=anchor)
+        draw.text(xy, text, font=font, fill=fill, anchor=anchor)
+        return
+    start = (math.modf(xy[0])[0], math.modf(xy[1])[0])
+    bitmap = text_bitmap_cache.get(text, font, draw.fontmode, anchor or "la", start, outline_width, persist=persist)
+    position = (int(xy[0]) + bitmap.offset[0], int(xy[1]) + bitmap.offset[1])
+    draw.bitmap(position, bitmap.outline, fill=outline_color)
+    draw.bitmap(position, bitmap.mask, fill=fill)
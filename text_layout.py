@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from hyphen import Hyphenator, textwrap2
+from PIL import ImageDraw, ImageFont
+import json
+import metrics
+import os
+
+TEXT_FIT_CACHE_SIZE = 4096  # fitted strings kept between cells and renders
+WRAP_CACHE_SIZE = 2048  # wrapped event texts kept between renders
+WRAP_CACHE_FILE = "cache/wrap.json"  # set to None to keep wrap layouts in memory only
+HYPHENATION_LANGUAGE = "sv_SE"
+
+_fit_cache = OrderedDict()
+_wrap_cache = None
+_wrap_cache_dirty = False
+_hyphenator = None
+
+
+def font_key(font: ImageFont.FreeTypeFont):
+    return (font.path, font.size, font.layout_engine)
+
+def fit_text(draw: ImageDraw.ImageDraw, text, font, max_width, suffix="", ellipsis="…"):
+    # Same result as chopping one character at a time until text + ellipsis + suffix fits,
+    # but with a binary search over the prefix length. If text + ellipsis + suffix already
+    # fits, the text is kept whole and the suffix is added after a space.
+    key = (text, suffix, ellipsis, font_key(font), draw.fontmode, max_width)
+    fitted = _fit_cache.get(key)
+    if fitted is not None:
+        _fit_cache.move_to_end(key)
+        metrics.count("text.fit_hits")
+        return fitted
+
+    tail = ellipsis + suffix
+    fits = lambda length: draw.textlength(text[:length] + tail, font=font) <= max_width
+
+    measured = 1
+    if fits(len(text)):
+        fitted = text + " " + suffix if suffix else text
+    else:
+        low, high = 0, len(text) - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            measured += 1
+            if fits(mid):
+                low = mid
+            else:
+                high = mid - 1
+        fitted = text[:low] + tail
+    metrics.count("text.measurements", measured)
+
+    _fit_cache[key] = fitted
+    if len(_fit_cache) > TEXT_FIT_CACHE_SIZE:
+        _fit_cache.popitem(last=False)
+    return fitted
+
+def get_hyphenator():
+    global _hyphenator
+    if _hyphenator is None:
+        _hyphenator = Hyphenator(HYPHENATION_LANGUAGE)
+    return _hyphenator
+
+def _load_wrap_cache():
+    global _wrap_cache
+    if _wrap_cache is None:
+        _wrap_cache = OrderedDict()
+        if WRAP_CACHE_FILE and os.path.exists(WRAP_CACHE_FILE):
+            try:
+                with open(WRAP_CACHE_FILE, "r") as f:
+                    _wrap_cache.update(json.load(f))
+            except (OSError, json.JSONDecodeError):
+                pass
+    return _wrap_cache
+
+def save_wrap_cache():
+    global _wrap_cache_dirty
+    if not WRAP_CACHE_FILE or not _wrap_cache_dirty:
+        return
+    os.makedirs(os.path.dirname(WRAP_CACHE_FILE) or ".", exist_ok=True)
+    with open(WRAP_CACHE_FILE + f".{os.getpid()}.tmp", "w") as f:
+        json.dump(_wrap_cache, f)
+    os.replace(WRAP_CACHE_FILE + f".{os.getpid()}.tmp", WRAP_CACHE_FILE)
+    _wrap_cache_dirty = False
+
+def wrap_text(draw: ImageDraw.ImageDraw, text, font, max_width, max_lines=4):
+    # Binary search for the largest character width whose hyphenated wrap fits max_width pixels
+    global _wrap_cache_dirty
+    wrap_cache = _load_wrap_cache()
+    key = json.dumps([text, max_width, font_key(font), draw.fontmode, max_lines])
+    lines = wrap_cache.get(key)
+    if lines is not None:
+        wrap_cache.move_to_end(key)
+        metrics.count("text.wrap_hits")
+        return lines
+
+    max_chars = int(max_width)
+    min_chars = 5  # Avoid too small widths that break hyphenator
+    best_lines = []
+    while min_chars <= max_chars:
+        mid_chars = (min_chars + max_chars) // 2
+        try:
+            wrapped_lines = textwrap2.wrap(text, max_lines=max_lines, width=mid_chars, break_long_words=True, use_hyphenator=get_hyphenator())
+            lines_good = all([draw.textlength(line, font=font) <= max_width for line in wrapped_lines])
+        except Exception:
+            # If hyphenator fails, treat as not good
+            lines_good = False
+            wrapped_lines = []
+        if lines_good:
+            best_lines = wrapped_lines
+            min_chars = mid_chars + 1
+        else:
+            max_chars = mid_chars - 1
+    lines = best_lines if best_lines else [text]
+    metrics.count("text.wrap_misses")
+
+    wrap_cache[key] = lines
+    if len(wrap_cache) > WRAP_CACHE_SIZE:
+        wrap_cache.popitem(last=False)
+    _wrap_cache_dirty = True
+    return lines
@@ -0,0 +1,154 @@
+from translate import Translator
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+import metrics
+
+TRANSLATIONS_FILE = "trans.jsonl"  # one {"text": ..., "translation": ...} per line, only ever appended to
+LEGACY_TRANSLATIONS_FILE = "trans.json"  # read once if present, from before the store
+TRANSLATE_TO = "sv"
+TRANSLATE_RETRY = 60 * 60  # seconds before a text that failed to translate is tried again
+TRANSLATE_EXIT_WAIT = 10  # seconds a finishing process waits for queued translations
+
+# Meteosource summaries, so the common ones never need the translation service
+BUNDLED_TRANSLATIONS = {
+    "Not available": "Inte tillgängligt",
+    "Sunny": "Soligt",
+    "Mostly sunny": "Mestadels soligt",
+    "Partly sunny": "Delvis soligt",
+    "Mostly cloudy": "Mestadels molnigt",
+    "Cloudy": "Molnigt",
+    "Overcast": "Mulet",
+    "Overcast with low clouds": "Mulet med låga moln",
+    "Fog": "Dimma",
+    "Light rain": "Lätt regn",
+    "Rain": "Regn",
+    "Possible rain": "Risk för regn",
+    "Rain shower": "Regnskurar",
+    "Thunderstorm": "Åska",
+    "Local thunderstorms": "Lokala åskväder",
+    "Light snow": "Lätt snöfall",
+    "Snow": "Snö",
+    "Possible snow": "Risk för snö",
+    "Snow shower": "Snöbyar",
+    "Rain and snow": "Regn och snö",
+    "Possible rain and snow": "Risk för regn och snö",
+    "Freezing rain": "Underkylt regn",
+    "Possible freezing rain": "Risk för underkylt regn",
+    "Hail": "Hagel",
+    "Clear": "Klart",
+    "Mostly clear": "Mestadels klart",
+    "Partly clear": "Delvis klart",
+}
+
+
+class TranslationStore:
+    # Translations are loaded once and looked up in memory. A miss returns the original text
+    # right away and is translated on a background thread, the next render picks it up.
+    def __init__(self, path=TRANSLATIONS_FILE, to_lang=TRANSLATE_TO, bundled=BUNDLED_TRANSLATIONS):
+        self.path = path
+        self.to_lang = to_lang
+        self.bundled = bundled
+        self.translations = None
+        self.failed = {}
+        self.pending = set()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def _load(self):
+        translations = {}
+        if os.path.exists(LEGACY_TRANSLATIONS_FILE):
+            try:
+                with open(LEGACY_TRANSLATIONS_FILE, "r") as f:
+                    translations.update(json.load(f))
+            except (OSError, json.JSONDecodeError):
+                pass
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        translations[entry["text"]] = entry["translation"]
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        # A line cut short by a crash, the text gets translated again
+                        continue
+        except OSError:
+            pass
+        return translations
+
+    def lookup(self, text):
+        with self.lock:
+            if self.translations is None:
+                self.translations = self._load()
+            translation = self.translations.get(text)
+        if translation is None:
+            translation = self.bundled.get(text) or self.bundled.get(text.capitalize())
+        return translation
+
+    def translate(self, text):
+        translation = self.lookup(text)
+        if translation is not None:
+            return translation
+        metrics.count("translations.misses")
+        self._request(text)
+        return text
+
+    def _request(self, text):
+        with self.lock:
+            if text in self.pending or time.time() - self.failed.get(text, 0) < TRANSLATE_RETRY:
+                return
+            self.pending.add(text)
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, name="translations", daemon=True)
+                self.worker.start()
+                atexit.register(self.wait, TRANSLATE_EXIT_WAIT)
+        self.queue.put(text)
+
+    def _run(self):
+        translator = Translator(to_lang=self.to_lang)
+        while True:
+            text = self.queue.get()
+            try:
+                with metrics.stage("translate"):
+                    translation = translator.translate(text)
+                self._add(text, translation)
+            except Exception as e:
+                print(f"Could not translate {text!r}: {e!r}")
+                with self.lock:
+                    self.failed[text] = time.time()
+            finally:
+                with self.lock:
+                    self.pending.discard(text)
+                self.queue.task_done()
+
+    def _add(self, text, translation):
+        # One write of one line with O_APPEND, so concurrent processes and crashes can't
+        # interleave or truncate earlier entries
+        line = json.dumps({"text": text, "translation": translation}, ensure_ascii=False) + "\n"
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+        with self.lock:
+            self.translations[text] = translation
+
+    def wait(self, timeout=None):
+        # Waits for queued translations, at most timeout seconds
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+
+translation_store = TranslationStore()
+
+def translate(text):
+    return translation_store.translate(text)
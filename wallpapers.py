@@ -0,0 +1,97 @@
+from PIL import Image
+import hashlib
+import json
+import os
+
+WALLPAPER_CACHE_DIR = "cache/wallpapers"
+WALLPAPER_EXTENSIONS = (".jpg", ".png")
+
+
+class WallpaperCache:
+    # Wallpapers and photos scaled to the display once and kept as PNGs in the cache directory,
+    # with an index of every folder so picking one doesn't touch the sources. A cached copy is
+    # redone when the source's mtime or size changes. With a palette the cached copy is already
+    # dithered to the display colours, which changes how it looks next to the later quantize.
+    def __init__(self, size, directory=WALLPAPER_CACHE_DIR, palette=None):
+        self.size = size
+        self.directory = directory
+        self.palette = palette
+        self.index_file = os.path.join(directory, "index.json")
+        self.index = None
+
+    def _load_index(self):
+        if self.index is None:
+            try:
+                with open(self.index_file, "r") as f:
+                    self.index = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self.index = {}
+            self.index.setdefault("folders", {})
+            self.index.setdefault("images", {})
+        return self.index
+
+    def _save_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.index_file + f".{os.getpid()}.tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_file + f".{os.getpid()}.tmp", self.index_file)
+
+    def images(self, folder):
+        # Sorted image paths in folder, only listed again when the folder itself changes
+        index = self._load_index()
+        mtime = os.stat(folder).st_mtime
+        entry = index["folders"].get(folder)
+        if entry is None or entry["mtime"] != mtime:
+            names = sorted(f for f in os.listdir(folder) if f.endswith(WALLPAPER_EXTENSIONS))
+            entry = {"mtime": mtime, "images": [os.path.join(folder, f) for f in names]}
+            index["folders"][folder] = entry
+            self._prune()
+            self._save_index()
+        return entry["images"]
+
+    def _variant(self):
+        return f"{self.size[0]}x{self.size[1]}" + ("-" + hashlib.sha256(bytes(self.palette)).hexdigest()[:8] if self.palette else "")
+
+    def load(self, path):
+        index = self._load_index()
+        stat = os.stat(path)
+        key = path + ":" + self._variant()
+        entry = index["images"].get(key)
+        if entry is not None and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            try:
+                with Image.open(os.path.join(self.directory, entry["file"])) as im:
+                    return im.convert("RGB")
+            except OSError:
+                pass
+
+        image = self.prepare(path)
+        file = hashlib.sha256(key.encode("utf-8")).hexdigest() + ".png"
+        os.makedirs(self.directory, exist_ok=True)
+        image.save(os.path.join(self.directory, file + f".{os.getpid()}.tmp"), format="PNG", compress_level=1)
+        os.replace(os.path.join(self.directory, file + f".{os.getpid()}.tmp"), os.path.join(self.directory, file))
+        index["images"][key] = {"mtime": stat.st_mtime, "size": stat.st_size, "file": file}
+        self._save_index()
+        return image
+
+    def prepare(self, path):
+        with Image.open(path) as im:
+            # JPEGs are decoded at the smallest DCT scale that is still twice the display size,
+            # which is far cheaper than a full decode and leaves enough pixels for a clean resize
+            im.draft("RGB", (self.size[0] * 2, self.size[1] * 2))
+            image = im.convert("RGB").resize(self.size)
+        if self.palette:
+            palette_image = Image.new("P", (1, 1))
+            palette_image.putpalette(self.palette)
+            image = image.quantize(len(self.palette) // 3, palette=palette_image).convert("RGB")
+        return image
+
+    def _prune(self):
+        # Drop cached copies whose sources are gone
+        index = self._load_index()
+        for key, entry in list(index["images"].items()):
+            if not os.path.exists(key.rsplit(":", 1)[0]):
+                try:
+                    os.remove(os.path.join(self.directory, entry["file"]))
+                except FileNotFoundError:
+                    pass
+                del index["images"][key]
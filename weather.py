@@ -1,19 +1,39 @@
 # Import the module.
 from datetime import datetime, timedelta
-from pymeteosource.api import Meteosource
+from pymeteosource.data import Forecast
 from pymeteosource.types import tiers
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance
-from translate import Translator
+from PIL import Image, ImageDraw, ImageEnhance
+from compositor import composite_text
+from fonts import get_font, prewarm
+from translations import translate
+import metrics
+import fcntl
+import functools
 import random
 import json
 import os
+import requests
+import time
 
 # Change this to your actual API key
-with open("api_key.txt", "r") as f:
-    YOUR_API_KEY = f.read().strip()
+API_KEY_FILE = "api_key.txt"
 # Change this to your actual tier
 YOUR_TIER = tiers.FREE
 
+FORECAST_PLACE = "Uppsala"
+FORECAST_TZ = "Europe/Stockholm"
+FORECAST_CACHE_FILE = "cache/forecast.json"
+FORECAST_TTL = 30 * 60  # seconds, at most one API call per TTL
+FORECAST_URL = "https://www.meteosource.com/api/v1/{tier}/point"
+FORECAST_TIMEOUT = 20  # seconds
+FONT_PATH = "font/noto-sans/NotoSans_Condensed-Bold.ttf"
+ICON_DIR = "weather-icons"
+ICON_COUNT = 64
+ICON_CACHE_SIZE = 256  # scaled icons kept in memory
+ICON_ATLAS_DIR = "cache/icons"  # set to None to always scale from the source PNGs
+# Point this at a saved forecast (same format as FORECAST_CACHE_FILE) to render without the API
+FORECAST_RECORDING = os.environ.get("KALENDAR_FORECAST_RECORDING")
+
 weather_dict = {
     1: 63,  # Not available
     2: 0,  # Sunny
@@ -53,54 +73,182 @@ weather_dict = {
     36: 33,  # Possible rain and snow (night)
 }
 
-def translate(to_trans):
-    trans = ""
-    found_trans = False
-    data = {}
-    if os.path.exists("trans.json"):
-        with open("trans.json", "r") as f:
-            try:
-                data = json.load(f)
-            except json.JSONDecodeError:
-                data = {}
-            if to_trans in data.keys():
-                trans = data[to_trans]
-                found_trans = True
-
-    if not found_trans:   
-        transer = Translator(to_lang="sv")
-        trans = transer.translate(to_trans)
-        data[to_trans] = trans
-        with open("trans.json", "w") as f:
-            json.dump(data, f)
+def icon_path(icon_set, icon_num):
+    return f"{ICON_DIR}/{icon_set}/Weather Icon-{icon_num}.png"
+
+def scale_icon(icon_set, icon_num, size, brightness=1.0):
+    icon_img = Image.open(icon_path(icon_set, icon_num)).convert("RGBA").resize(size)
+    if brightness != 1.0:
+        icon_img = ImageEnhance.Brightness(icon_img).enhance(brightness)
+    return icon_img
+
+def icon_sources_signature(icon_set):
+    signature = []
+    for icon_num in range(ICON_COUNT):
+        st = os.stat(icon_path(icon_set, icon_num))
+        signature.append([st.st_mtime_ns, st.st_size])
+    return signature
+
+@functools.lru_cache(maxsize=16)
+def load_icon_atlas(icon_set, size, brightness):
+    # All icons of a set pre-scaled side by side in one PNG, rebuilt when any source icon changes
+    name = f"{icon_set}-{size[0]}x{size[1]}-{brightness}"
+    atlas_path = os.path.join(ICON_ATLAS_DIR, name + ".png")
+    manifest_path = os.path.join(ICON_ATLAS_DIR, name + ".json")
+    signature = icon_sources_signature(icon_set)
+
+    try:
+        with open(manifest_path, "r") as f:
+            if json.load(f) == signature:
+                atlas = Image.open(atlas_path)
+                atlas.load()
+                return atlas
+    except (OSError, json.JSONDecodeError):
+        pass
+
+    atlas = Image.new("RGBA", (size[0] * ICON_COUNT, size[1]), (0, 0, 0, 0))
+    for icon_num in range(ICON_COUNT):
+        atlas.paste(scale_icon(icon_set, icon_num, size, brightness), (icon_num * size[0], 0))
+
+    os.makedirs(ICON_ATLAS_DIR, exist_ok=True)
+    atlas.save(atlas_path + f".{os.getpid()}.tmp", format="PNG")
+    os.replace(atlas_path + f".{os.getpid()}.tmp", atlas_path)
+    with open(manifest_path, "w") as f:
+        json.dump(signature, f)
+    return atlas
+
+@functools.lru_cache(maxsize=ICON_CACHE_SIZE)
+def get_icon(icon_set, icon_num, size, brightness=1.0):
+    # Shared between callers, only paste it, never draw on it
+    if ICON_ATLAS_DIR is None:
+        return scale_icon(icon_set, icon_num, size, brightness)
+    atlas = load_icon_atlas(icon_set, size, brightness)
+    return atlas.crop((icon_num * size[0], 0, (icon_num + 1) * size[0], size[1]))
+
+@functools.lru_cache(maxsize=ICON_CACHE_SIZE)
+def get_micro_icon(icon_set, icon_num, w, h):
+    img = Image.new("RGBA", (w, h), (255, 255, 255, 0))
+
+    draw = ImageDraw.Draw(img)
     
-    return trans
+    draw.ellipse([0,0,w-1,h-1], fill="white")
+
+    icon_img = get_icon(icon_set, icon_num, (w-2,h-2), brightness=0.8 if icon_set == "color" else 1.0)
+
+    img.paste(icon_img, (1,1), icon_img)
+
+    if icon_set == "fill-black":
+        img = ImageEnhance.Contrast(img).enhance(2)
+
+    return img
+
+def prewarm_fonts():
+    prewarm([(FONT_PATH, range(10, 41), None), (FONT_PATH, [75], None)])
+
+def fetch_forecast_data():
+    # The point endpoint Meteosource.get_point_forecast calls, but we keep the raw response so it
+    # can be cached and turned into a Forecast later
+    with open(API_KEY_FILE, "r") as f:
+        api_key = f.read().strip()
+    pars = {"place_id": FORECAST_PLACE, "language": "en", "units": "metric", "timezone": "UTC", "sections": "current,hourly,daily"}
+    response = requests.get(FORECAST_URL.format(tier=YOUR_TIER), params=pars, headers={"X-API-Key": api_key}, timeout=FORECAST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+def load_recorded_forecast(path):
+    with open(path, "r") as f:
+        return json.load(f)["data"]
+
+class ForecastProvider:
+    def __init__(self, cache_file=FORECAST_CACHE_FILE, ttl=FORECAST_TTL, fetch=None):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        if fetch is None:
+            fetch = (lambda: load_recorded_forecast(FORECAST_RECORDING)) if FORECAST_RECORDING else fetch_forecast_data
+        self.fetch = fetch
+        self.forecast = None
+        self.fetched = 0
+        self.attempted = 0  # last API call, failed or not
+
+    def _load(self):
+        try:
+            with open(self.cache_file, "r") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _save(self, cached):
+        with open(self.cache_file + f".{os.getpid()}.tmp", "w") as f:
+            json.dump(cached, f)
+        os.replace(self.cache_file + f".{os.getpid()}.tmp", self.cache_file)
+
+    def _use(self, cached):
+        self.forecast = Forecast(cached["data"], FORECAST_TZ)
+        self.fetched = cached["fetched"]
+        self.attempted = cached.get("attempted", self.fetched)
+        return self.forecast
+
+    def _is_fresh(self, cached):
+        # A failed call counts too, so a down or rate limited API is asked at most once per TTL
+        return time.time() - cached.get("attempted", cached["fetched"]) < self.ttl
+
+    def get_forecast(self):
+        if self.forecast is not None and time.time() - self.attempted < self.ttl:
+            metrics.count("forecast.memory_hits")
+            return self.forecast
+
+        cached = self._load()
+        if cached and self._is_fresh(cached):
+            return self._use(cached)
+
+        os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+        with open(self.cache_file + ".lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is refreshing, use what we have or wait for its result
+                if cached:
+                    return self._use(cached)
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # It may have been refreshed while we waited for the lock
+            cached = self._load() or cached
+            if cached and self._is_fresh(cached):
+                return self._use(cached)
+
+            try:
+                with metrics.stage("forecast.fetch"):
+                    data = self.fetch()
+            except Exception as e:
+                if not cached:
+                    raise
+                print(f"Could not refresh forecast, using the one from {datetime.fromtimestamp(cached['fetched'])}: {e!r}")
+                cached["attempted"] = time.time()
+                self._save(cached)
+                return self._use(cached)
+
+            cached = {"fetched": time.time(), "data": data}
+            self._save(cached)
+            return self._use(cached)
+
+forecast_provider = ForecastProvider()
 
 class CalWeather:
-    def __init__(self):
-        meteosource = Meteosource(YOUR_API_KEY, YOUR_TIER)
-        self.forecast = meteosource.get_point_forecast(
-            place_id="Uppsala",
-            tz="Europe/Stockholm",
-            lang="en",
-            units="metric",
-            sections=["current", "hourly", "daily"],
-        )
+    def __init__(self, forecast=None):
+        self.forecast = forecast if forecast is not None else forecast_provider.get_forecast()
 
     def get_image(self, w, h):
         # Create a blank image with white background
         img = Image.new("RGBA", (w, h), (255, 255, 255, 0))
 
-        icon_img = Image.open(
-            f"weather-icons/color/Weather Icon-{weather_dict[self.forecast.current.icon_num]}.png"
-        ).convert("RGBA").resize((int(w*0.75),int(w*0.75)))
+        icon_img = get_icon("color", weather_dict[self.forecast.current.icon_num], (int(w*0.75),int(w*0.75)))
         img.paste(icon_img, (0, 0), icon_img)
         draw = ImageDraw.Draw(img)
 
         draw.text(
             (w, int(w*0.75)),
             f"{round(self.forecast.current.temperature)}°",
-            font=ImageFont.truetype("font/noto-sans/NotoSans_Condensed-Bold.ttf", 75),
+            font=get_font(FONT_PATH, 75),
             fill="#FFFFFF",
             anchor="rb"
         )
@@ -108,9 +256,9 @@ class CalWeather:
         summary = self.forecast.current.summary
         summary_sv = translate(summary)
 
-        font = ImageFont.truetype("font/noto-sans/NotoSans_Condensed-Bold.ttf", 40)
+        font = get_font(FONT_PATH, 40)
         while draw.textlength(summary_sv, font=font) > w - 10 and font.size > 10:
-            font = font.font_variant(size=font.size - 1)
+            font = get_font(FONT_PATH, font.size - 1)
         draw.text(
             (5, h-50),
             summary_sv,
@@ -145,15 +293,13 @@ class CalWeather:
         
         draw.ellipse([bubble_x, h-bubble_size, bubble_x+bubble_size, h], fill="white")
 
-        icon_img = Image.open(
-            f"weather-icons/color/Weather Icon-{weather_dict[fc.icon]}.png"
-        ).convert("RGBA").resize((icon_w, icon_h))
+        icon_img = get_icon("color", weather_dict[fc.icon], (icon_w, icon_h))
         img.paste(icon_img, (icon_x, icon_y), icon_img)
 
         text_draw.text(
             (int(w/2),5),
             f"{fc.date.strftime('%H')}",
-            font=ImageFont.truetype("font/noto-sans/NotoSans_Condensed-Bold.ttf", 10),
+            font=get_font(FONT_PATH, 10),
             fill="#000000",
             anchor="mt"
         )
@@ -161,11 +307,11 @@ class CalWeather:
         text_draw.text(
             (int(w/2),h-10),
             f"{round(fc.temperature)}°",
-            font=ImageFont.truetype("font/noto-sans/NotoSans_Condensed-Bold.ttf", 10),
+            font=get_font(FONT_PATH, 10),
             fill="#000000",
             anchor="mt"
         )
-        img = Image.composite(img, text_img.convert("RGBA"), text_img.convert("L").point(lambda x: 255 if x == 17 else 0))
+        img = composite_text(img, text_img)
         return img
     
     def get_micro_image(self, w, h, date, color="fill-black"):
@@ -179,25 +325,7 @@ class CalWeather:
         if fc is None:
             return Image.new("RGBA", (w, h), (255, 255, 255, 0))
 
-        img = Image.new("RGBA", (w, h), (255, 255, 255, 0))
-
-        draw = ImageDraw.Draw(img)
-        
-        draw.ellipse([0,0,w-1,h-1], fill="white")
-
-        icon_img = Image.open(
-            f"weather-icons/{color}/Weather Icon-{weather_dict[fc.icon]}.png"
-        ).convert("RGBA").resize((w-2,h-2))
-
-        if color == "color":
-            icon_img = ImageEnhance.Brightness(icon_img).enhance(0.8)
-
-        img.paste(icon_img, (1,1), icon_img)
-
-        if color == "fill-black":
-            img = ImageEnhance.Contrast(img).enhance(2)
-
-        return img
+        return get_micro_icon(color, weather_dict[fc.icon], w, h)
 
 
 if __name__ == "__main__":